@@ -1 +1,3 @@
 __version__ = '0.1.1'
+
+default_app_config = 'django_sftpserver.apps.DjangoSftpserverConfig'
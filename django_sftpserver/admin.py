@@ -15,7 +15,7 @@ class AuthorizedKeyAdmin(admin.ModelAdmin):
 
 @admin.register(models.Root)
 class RootAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'branch')
+    list_display = ('id', 'name', 'branch', 'codec')
 
 
 @admin.register(models.MetaFile)
@@ -25,12 +25,32 @@ class MetaFileAdmin(admin.ModelAdmin):
 
 @admin.register(models.Data)
 class DataAdmin(admin.ModelAdmin):
-    list_display = ('id', 'size', 'key', 'parent_key')
+    list_display = ('id', 'size', 'key', 'parent_key', 'chunked', 'codec')
+
+
+@admin.register(models.Chunk)
+class ChunkAdmin(admin.ModelAdmin):
+    list_display = ('id', 'size', 'key', 'codec')
+
+
+@admin.register(models.DeltaTask)
+class DeltaTaskAdmin(admin.ModelAdmin):
+    list_display = ('id', 'key', 'parent_key', 'created_at', 'started_at')
 
 
 @admin.register(models.Commit)
 class CommitAdmin(admin.ModelAdmin):
-    list_display = ('id', 'root', 'name', 'creator', 'created_at', 'key')
+    list_display = ('id', 'root', 'name', 'creator', 'created_at', 'key', 'tree_key')
+
+
+@admin.register(models.Tree)
+class TreeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'key', 'created_at')
+
+
+@admin.register(models.TreeEntry)
+class TreeEntryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'tree', 'name', 'key', 'tree_key')
 
 
 @admin.register(models.CommitItem)
@@ -4,3 +4,14 @@ from django.apps import AppConfig
 
 class DjangoSftpserverConfig(AppConfig):
     name = 'django_sftpserver'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from django.db.models.signals import m2m_changed
+        from . import models
+
+        # group membership of users grants access to roots and storages
+        groups = getattr(get_user_model(), 'groups', None)
+        if groups is not None:
+            m2m_changed.connect(models._invalidate_roots, sender=groups.through)
+            m2m_changed.connect(models._invalidate_permissions, sender=groups.through)
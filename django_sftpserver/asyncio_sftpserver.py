@@ -0,0 +1,284 @@
+# coding: utf-8
+'''
+asyncio engine built on asyncssh.
+
+The SSH and SFTP protocols run on a single event loop, so idle sessions cost
+no thread. Authentication and every file operation are delegated to the
+paramiko based ``StubServer`` / ``StubSFTPServer`` of ``sftpserver`` (or
+``storage_sftpserver``) and run on a bounded thread pool, which keeps root
+resolution, permission checks and ``Root`` / ``MetaFile`` semantics identical
+to the threaded engine.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import io
+import time
+import asyncio
+import logging
+import functools
+import threading
+import concurrent.futures
+
+import asyncssh
+import paramiko
+
+logger = logging.getLogger(__name__)
+
+
+def _attrs(attr):
+    return asyncssh.SFTPAttrs(
+        size=attr.st_size, uid=attr.st_uid, gid=attr.st_gid, permissions=attr.st_mode,
+        atime=None if attr.st_atime is None else int(attr.st_atime),
+        mtime=None if attr.st_mtime is None else int(attr.st_mtime))
+
+
+def _check(retval):
+    # paramiko status codes share their values with the SFTP protocol codes
+    if isinstance(retval, int) and retval != paramiko.SFTP_OK:
+        raise asyncssh.SFTPError(retval, paramiko.sftp.SFTP_DESC[retval])
+    return retval
+
+
+def _convert_pflags(pflags):
+    if (pflags & asyncssh.FXF_READ) and (pflags & asyncssh.FXF_WRITE):
+        flags = os.O_RDWR
+    elif pflags & asyncssh.FXF_WRITE:
+        flags = os.O_WRONLY
+    else:
+        flags = os.O_RDONLY
+    if pflags & asyncssh.FXF_APPEND:
+        flags |= os.O_APPEND
+    if pflags & asyncssh.FXF_CREAT:
+        flags |= os.O_CREAT
+    if pflags & asyncssh.FXF_TRUNC:
+        flags |= os.O_TRUNC
+    if pflags & asyncssh.FXF_EXCL:
+        flags |= os.O_EXCL
+    return flags
+
+
+def import_host_key(key):
+    '''convert a paramiko key (or read a key file) into an asyncssh key'''
+    if not isinstance(key, paramiko.PKey):
+        return asyncssh.read_private_key(key)
+    buf = io.StringIO()
+    key.write_private_key(buf)
+    return asyncssh.import_private_key(buf.getvalue())
+
+
+class _PublicKey(object):
+    '''the subset of paramiko.PKey used by StubServer.check_auth_publickey'''
+
+    def __init__(self, key):
+        self._name, self._base64 = key.export_public_key('openssh').decode('ascii').split()[:2]
+
+    def get_name(self):
+        return self._name
+
+    def get_base64(self):
+        return self._base64
+
+
+class AsyncStubServer(asyncssh.SSHServer):
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.stub = None
+        self.conn = None
+
+    def connection_made(self, conn):
+        self.conn = conn
+        self.started_at = time.time()
+        self.stub = self.engine.sftpserver_module.StubServer(conn.get_extra_info('peername'))
+        self.engine.connection_made(self)
+
+    def connection_lost(self, exc):
+        self.engine.connection_lost(self)
+
+    def begin_auth(self, username):
+        return True
+
+    def public_key_auth_supported(self):
+        return True
+
+    async def validate_public_key(self, username, key):
+        result = await self.engine.run(self.stub.check_auth_publickey, username, _PublicKey(key))
+        return result == paramiko.AUTH_SUCCESSFUL
+
+
+class AsyncStubSFTPServer(asyncssh.SFTPServer):
+
+    def __init__(self, chan):
+        super(AsyncStubSFTPServer, self).__init__(chan)
+        self._server = chan.get_connection().get_owner()
+        self._stub = None
+        self._lock = threading.Lock()
+
+    def _call(self, name, *args):
+        # StubSFTPServer may query the database while initializing, so it is
+        # created on the executor as well
+        def f():
+            with self._lock:
+                if self._stub is None:
+                    self._stub = self._server.engine.sftpserver_module.StubSFTPServer(self._server.stub)
+                    self._stub.session_started()
+            return getattr(self._stub, name)(*args)
+        return self._run(f)
+
+    def _run(self, f, *args):
+        return self._server.engine.run(f, *args)
+
+    async def open(self, path, pflags, attrs):
+        return _check(await self._call('open', path.decode('utf-8'), _convert_pflags(pflags), None))
+
+    async def close(self, file_obj):
+        await self._run(file_obj.close)
+
+    async def read(self, file_obj, offset, size):
+        return _check(await self._run(file_obj.read, offset, size))
+
+    async def write(self, file_obj, offset, data):
+        _check(await self._run(file_obj.write, offset, data))
+        return len(data)
+
+    async def fstat(self, file_obj):
+        return _attrs(_check(await self._run(file_obj.stat)))
+
+    async def listdir(self, path):
+        result = _check(await self._call('list_folder', path.decode('utf-8')))
+        return [asyncssh.SFTPName(x.filename.encode('utf-8'), attrs=_attrs(x)) for x in result]
+
+    async def stat(self, path):
+        return _attrs(_check(await self._call('stat', path.decode('utf-8'))))
+
+    async def lstat(self, path):
+        return _attrs(_check(await self._call('lstat', path.decode('utf-8'))))
+
+    async def realpath(self, path):
+        return (await self._call('canonicalize', path.decode('utf-8'))).encode('utf-8')
+
+    async def remove(self, path):
+        _check(await self._call('remove', path.decode('utf-8')))
+
+    async def rename(self, oldpath, newpath):
+        _check(await self._call('rename', oldpath.decode('utf-8'), newpath.decode('utf-8')))
+
+    posix_rename = rename
+
+    async def mkdir(self, path, attrs):
+        _check(await self._call('mkdir', path.decode('utf-8'), None))
+
+    async def rmdir(self, path):
+        _check(await self._call('rmdir', path.decode('utf-8')))
+
+    def setstat(self, path, attrs):
+        raise asyncssh.SFTPError(asyncssh.FX_OP_UNSUPPORTED, 'Operation unsupported')
+
+    fsetstat = lsetstat = setstat
+
+    def readlink(self, path):
+        raise asyncssh.SFTPError(asyncssh.FX_OP_UNSUPPORTED, 'Operation unsupported')
+
+    def symlink(self, oldpath, newpath):
+        raise asyncssh.SFTPError(asyncssh.FX_OP_UNSUPPORTED, 'Operation unsupported')
+
+    def exit(self):
+        if self._stub is not None:
+            self._stub.session_ended()
+
+
+class AsyncioEngine(object):
+    '''
+    Serves SFTP sessions on an asyncio event loop.
+
+    max_threads bounds the number of blocking ORM / storage calls running at
+    the same time (and so the number of database connections).
+    '''
+
+    def __init__(self, sftpserver_module, host_keys, max_threads=32, max_sessions=0,
+                 accept_timeout=30, max_accepted=0, idle_timeout=0, max_lifetime=0, drain_timeout=30):
+        self.sftpserver_module = sftpserver_module
+        self.host_keys = [import_host_key(x) for x in host_keys]
+        self.max_sessions = max_sessions
+        self.accept_timeout = accept_timeout
+        self.max_accepted = max_accepted
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.drain_timeout = drain_timeout
+        self.accepted = 0
+        self.connections = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_threads)
+
+    def run(self, f, *args):
+        return asyncio.get_event_loop().run_in_executor(self._executor, functools.partial(f, *args))
+
+    def connection_made(self, server):
+        if self.max_sessions and len(self.connections) >= self.max_sessions:
+            logger.warning('max sessions ({}) reached, rejecting {}'.format(
+                self.max_sessions, server.conn.get_extra_info('peername')))
+            server.conn.close()
+            return
+        self.accepted += 1
+        self.connections.add(server)
+
+    def connection_lost(self, server):
+        self.connections.discard(server)
+
+    def reap(self):
+        now = time.time()
+        for server in list(self.connections):
+            last_activity = getattr(server.stub, 'last_activity', None) or server.started_at
+            if self.max_lifetime and now - server.started_at > self.max_lifetime:
+                reason = 'max lifetime'
+            elif self.idle_timeout and now - last_activity > self.idle_timeout:
+                reason = 'idle timeout'
+            else:
+                continue
+            logger.info('closing session of {}: {}'.format(server.stub.client_addr, reason))
+            server.conn.close()
+
+    def serve(self, server_socket, is_running, poll_interval=1, recycling=None):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._serve(server_socket, is_running, poll_interval, recycling))
+        finally:
+            loop.close()
+            self._executor.shutdown(wait=True)
+
+    async def _serve(self, server_socket, is_running, poll_interval, recycling=None):
+        server_socket.setblocking(False)
+        acceptor = await asyncssh.listen(
+            sock=server_socket,
+            server_factory=functools.partial(AsyncStubServer, self),
+            server_host_keys=self.host_keys,
+            sftp_factory=AsyncStubSFTPServer,
+            allow_scp=False,
+            login_timeout=self.accept_timeout)
+        try:
+            while is_running():
+                if self.max_accepted and self.accepted >= self.max_accepted:
+                    logger.info('worker {} served {} sessions, recycling'.format(os.getpid(), self.accepted))
+                    break
+                self.reap()
+                await asyncio.sleep(poll_interval)
+        finally:
+            acceptor.close()
+        if is_running():
+            # recycled, the sessions are not cut off until a shutdown
+            if recycling is not None:
+                recycling()
+            while self.connections and is_running():
+                self.reap()
+                await asyncio.sleep(poll_interval)
+        deadline = time.time() + self.drain_timeout
+        while self.connections and time.time() < deadline:
+            self.reap()
+            await asyncio.sleep(poll_interval)
+        for server in list(self.connections):
+            logger.warning('drain deadline exceeded, closing session of {}'.format(server.stub.client_addr))
+            server.conn.close()
+        await acceptor.wait_closed()
@@ -0,0 +1,89 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import hashlib
+import tempfile
+
+from . import conf
+
+READ_SIZE = 64 * 1024
+
+# every algorithm gives 40 hexadecimal digits, the size of the key columns
+HASH_ALGORITHMS = {
+    'sha1': hashlib.sha1,
+}
+if hasattr(hashlib, 'blake2b'):
+    HASH_ALGORITHMS['blake2b'] = lambda: hashlib.blake2b(digest_size=20)
+    HASH_ALGORITHMS['blake2s'] = lambda: hashlib.blake2s(digest_size=20)
+
+
+def new_hash(algorithm=None):
+    '''a hash object of SFTPSERVER_HASH_ALGORITHM'''
+    return HASH_ALGORITHMS[algorithm or conf.get('HASH_ALGORITHM')]()
+
+
+def hexdigest(value, algorithm=None):
+    h = new_hash(algorithm)
+    h.update(value)
+    return h.hexdigest()
+
+
+class SpooledBlob(object):
+    '''
+    Upload buffer for a file version.
+
+    Content stays in memory up to SPOOL_MAX_MEMORY bytes and is spilled to a
+    temporary file beyond that. The hash and the size are updated while the
+    file is written sequentially, so computing the key on close does not need
+    another pass unless the client rewrote data it had already sent.
+    '''
+
+    def __init__(self, max_memory=None, algorithm=None):
+        if max_memory is None:
+            max_memory = conf.get('SPOOL_MAX_MEMORY')
+        self.algorithm = algorithm or conf.get('HASH_ALGORITHM')
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._hash = new_hash(self.algorithm)
+        self._hashed = 0
+        self.size = 0
+
+    def write(self, offset, data):
+        self._file.seek(offset)
+        self._file.write(data)
+        if self._hash is not None:
+            if offset == self._hashed:
+                self._hash.update(data)
+                self._hashed += len(data)
+            elif offset < self._hashed:
+                # bytes that were already hashed changed
+                self._hash = None
+        self.size = max(self.size, offset + len(data))
+
+    def read(self, offset, length):
+        self._file.seek(offset)
+        return self._file.read(max(0, min(length, self.size - offset)))
+
+    def iter_chunks(self, chunk_size=READ_SIZE, offset=0):
+        while offset < self.size:
+            data = self.read(offset, chunk_size)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+
+    def hexdigest(self):
+        if self._hash is None:
+            self._hash = new_hash(self.algorithm)
+            self._hashed = 0
+        for data in self.iter_chunks(offset=self._hashed):
+            self._hash.update(data)
+            self._hashed += len(data)
+        return self._hash.hexdigest()
+
+    def getvalue(self):
+        return self.read(0, self.size)
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,124 @@
+# coding: utf-8
+'''
+Cache of decoded file versions.
+
+Entries are kept in an in-process LRU bounded by their total size, and
+optionally in a django cache shared by the processes (SFTPSERVER_BLOB_CACHE
+names the alias). Blobs larger than SFTPSERVER_BLOB_CACHE_MAX_ENTRY are never
+cached, so one huge file can not evict everything else or be rejected by
+memcached.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import threading
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import conf
+
+
+class BlobCache(object):
+
+    def __init__(self, max_size, max_entry_size, backend=None, timeout=None):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.backend = backend
+        self.timeout = timeout
+        self.size = 0
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                # most recently used last
+                self._entries[key] = value
+                self.hits += 1
+                return value
+        if self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self.backend_hits += 1
+                self._store(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        if len(value) > self.max_entry_size:
+            self.skipped += 1
+            return False
+        self._store(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value, self.timeout)
+        return True
+
+    def _store(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def clear(self):
+        '''drop the local entries, the django cache is left untouched'''
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'hits': self.hits,
+            'backend_hits': self.backend_hits,
+            'misses': self.misses,
+            'skipped': self.skipped,
+        }
+
+
+_blob_cache = None
+
+
+def get_blob_cache():
+    global _blob_cache
+    if _blob_cache is None:
+        alias = conf.get('BLOB_CACHE')
+        _blob_cache = BlobCache(
+            conf.get('BLOB_CACHE_SIZE'), conf.get('BLOB_CACHE_MAX_ENTRY'),
+            backend=caches[alias] if alias else None, timeout=conf.get('BLOB_CACHE_TIMEOUT'))
+    return _blob_cache
+
+
+@receiver(setting_changed)
+def _reset_blob_cache(setting, **kwargs):
+    global _blob_cache
+    if setting.startswith('SFTPSERVER_BLOB_CACHE'):
+        _blob_cache = None
@@ -0,0 +1,118 @@
+# coding: utf-8
+'''
+Content-defined chunking.
+
+Chunk boundaries are placed where a rolling gear hash of the last WINDOW
+bytes matches a mask, so they only depend on the surrounding content: an
+insertion or an edit moves the boundaries next to it and leaves the chunks
+elsewhere (and in other files sharing the same content) unchanged.
+
+The hash of a position only depends on the WINDOW preceding bytes, which lets
+the boundary scan run over a whole buffer at once with numpy when it is
+installed. The pure Python scan produces the same boundaries.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import bisect
+import hashlib
+
+import six
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+WINDOW = 32
+MASK32 = 0xffffffff
+
+# fixed pseudo random table, boundaries must not change between processes
+GEAR = [int(hashlib.md5(six.int2byte(i)).hexdigest()[:8], 16) for i in range(256)]
+
+
+def _python_finder(buf, mask):
+    gear = GEAR
+
+    def find(lo, hi):
+        # first chunk end in [lo, hi], the hash is warmed up on WINDOW - 1 bytes
+        if lo > hi:
+            return None
+        h = 0
+        for p in range(lo - WINDOW, lo - 1):
+            h = ((h << 1) + gear[buf[p]]) & MASK32
+        for p in range(lo - 1, hi):
+            h = ((h << 1) + gear[buf[p]]) & MASK32
+            if not h & mask:
+                return p + 1
+        return None
+    return find
+
+
+def _numpy_finder(buf, mask):
+    h = numpy.array(GEAR, dtype=numpy.uint32)[numpy.frombuffer(bytes(buf), dtype=numpy.uint8)]
+    # h[i] = sum(gear[buf[i - j]] << j for j < WINDOW), built by doubling
+    shift = 1
+    while shift < WINDOW:
+        h[shift:] += h[:-shift] << numpy.uint32(shift)
+        shift *= 2
+    ends = (numpy.flatnonzero((h & numpy.uint32(mask)) == 0) + 1).tolist()
+
+    def find(lo, hi):
+        i = bisect.bisect_left(ends, lo)
+        if i < len(ends) and ends[i] <= hi:
+            return ends[i]
+        return None
+    return find
+
+
+class Chunker(object):
+    '''
+    Splits a stream into chunks of avg_size bytes on average, never shorter
+    than min_size (except the last one) nor longer than max_size.
+    '''
+
+    def __init__(self, avg_size, min_size=None, max_size=None, use_numpy=True):
+        self.min_size = max(WINDOW, avg_size // 4 if min_size is None else min_size)
+        self.max_size = max(self.min_size, avg_size * 4 if max_size is None else max_size)
+        bits = max(1, (max(avg_size - self.min_size, 2)).bit_length() - 1)
+        # the high bits of the hash depend on the whole window
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+        self.use_numpy = use_numpy and numpy is not None
+
+    def cut_points(self, buf):
+        '''ends of the chunks of buf which do not depend on what follows it'''
+        if self.use_numpy:
+            find = _numpy_finder(buf, self.mask)
+        else:
+            find = _python_finder(buf, self.mask)
+        cuts = []
+        start = 0
+        while True:
+            end = find(start + self.min_size, min(start + self.max_size, len(buf)))
+            if end is None:
+                if start + self.max_size > len(buf):
+                    break
+                end = start + self.max_size
+            cuts.append(end)
+            start = end
+        return cuts
+
+    def split(self, stream):
+        '''yield the chunks of an iterable of byte strings'''
+        buf = bytearray()
+        for data in stream:
+            buf.extend(data)
+            if len(buf) < 4 * self.max_size:
+                continue
+            start = 0
+            for end in self.cut_points(buf):
+                yield bytes(buf[start:end])
+                start = end
+            del buf[:start]
+        start = 0
+        for end in self.cut_points(buf) + [len(buf)]:
+            if end > start:
+                yield bytes(buf[start:end])
+            start = end
@@ -0,0 +1,66 @@
+# coding: utf-8
+'''
+Compression codecs of stored blobs.
+
+The codec is recorded next to every blob so that rows written with different
+settings (or before compression existed, 'none') keep decoding.
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import bz2
+import zlib
+import logging
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from django.utils.encoding import force_bytes
+
+from . import conf
+
+logger = logging.getLogger(__name__)
+
+NONE = 'none'
+
+CODECS = {
+    NONE: (lambda x: x, lambda x: x),
+    'zlib': (zlib.compress, zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+}
+if lzma is not None:
+    CODECS['lzma'] = (lzma.compress, lzma.decompress)
+
+CODEC_CHOICES = [(x, x) for x in (NONE, 'zlib', 'lzma', 'bz2')]
+
+PROBE_SIZE = 64 * 1024
+# a sample that does not shrink below this ratio is stored raw
+PROBE_RATIO = 0.9
+
+
+def compressible(value):
+    '''quick estimate on a sample with the fastest zlib level'''
+    sample = value[:PROBE_SIZE]
+    return len(zlib.compress(sample, 1)) < PROBE_RATIO * len(sample)
+
+
+def encode(value, codec=None):
+    '''returns (codec, payload), the codec actually used may be 'none' '''
+    value = force_bytes(value)
+    codec = codec or conf.get('CODEC')
+    if codec == NONE or len(value) < conf.get('COMPRESS_MIN_SIZE') or not compressible(value):
+        return NONE, value
+    if codec not in CODECS:
+        logger.warning('codec {} is not available, using zlib'.format(codec))
+        codec = 'zlib'
+    payload = CODECS[codec][0](value)
+    if len(payload) >= len(value):
+        return NONE, value
+    return codec, payload
+
+
+def decode(codec, payload):
+    return CODECS[codec or NONE][1](force_bytes(payload))
@@ -0,0 +1,56 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+from django.conf import settings
+
+DEFAULTS = {
+    # uploads are kept in memory up to this size, then spooled to a temporary file
+    'SPOOL_MAX_MEMORY': 4 * 1024 * 1024,
+    # read-only handles fetch stored content in ranges of this size
+    'READ_WINDOW': 1024 * 1024,
+    # versions larger than CHUNK_THRESHOLD are stored as chunks of CHUNK_SIZE
+    # bytes on average, split where the content allows it ('content') so that
+    # shifted or similar files share chunks, or at fixed offsets ('fixed')
+    'CHUNKING': 'content',
+    'CHUNK_SIZE': 256 * 1024,
+    'CHUNK_THRESHOLD': 1024 * 1024,
+    # a full version is stored instead of a delta once a chain is this deep
+    'MAX_DELTA_DEPTH': 16,
+    # store new versions in full and leave the delta compression to the
+    # django_sftpserver_delta command instead of computing it on close
+    'ASYNC_DELTA': False,
+    # codec of stored versions and chunks ('none', 'zlib', 'lzma' or 'bz2'),
+    # Root.codec overrides it; smaller or incompressible blobs are stored raw
+    'CODEC': 'zlib',
+    'COMPRESS_MIN_SIZE': 512,
+    # content keys: 'sha1', or 'blake2b' / 'blake2s' (python 3.6+) which are
+    # faster; keys made with another algorithm keep working
+    'HASH_ALGORITHM': 'sha1',
+    # decoded versions are cached in process up to BLOB_CACHE_SIZE bytes in
+    # total, and in the BLOB_CACHE django cache alias when it is set; versions
+    # larger than BLOB_CACHE_MAX_ENTRY are not cached
+    'BLOB_CACHE': None,
+    'BLOB_CACHE_SIZE': 64 * 1024 * 1024,
+    'BLOB_CACHE_MAX_ENTRY': 4 * 1024 * 1024,
+    'BLOB_CACHE_TIMEOUT': 24 * 60 * 60,
+    # seconds a session reuses a resolved root and permission; changes made in
+    # the same process are applied at once
+    'ROOT_CACHE_TIMEOUT': 60,
+    # the roots and storages a user can access are cached in the default cache
+    # for up to this many seconds, 0 disables it. A membership change
+    # invalidates them at once only in the processes sharing that cache: with
+    # the default LocMemCache every process (the admin, the server, each
+    # prefork worker) has its own, and the others keep a removed access until
+    # the timeout. Configure a shared cache (memcached, redis) before raising it
+    'PERMISSION_CACHE_TIMEOUT': 60,
+    # removed directories are only detached, their content is deleted later by
+    # the django_sftpserver_purge command
+    'DEFERRED_DELETE': False,
+}
+
+
+def get(name):
+    '''read SFTPSERVER_<name> from the django settings'''
+    return getattr(settings, 'SFTPSERVER_' + name, DEFAULTS[name])
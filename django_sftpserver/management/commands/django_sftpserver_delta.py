@@ -0,0 +1,70 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import time
+import logging
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from ... import models
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Compress the versions queued by SFTPSERVER_ASYNC_DELTA into deltas'
+    CONCURRENCY = 2
+    STALE = 600
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', dest='concurrency', type=int, default=self.CONCURRENCY,
+            help='number of versions compressed at the same time [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--interval', dest='interval', type=int, default=0,
+            help='keep running and poll the queue every N seconds, 0 stops once it is empty [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--stale', dest='stale', type=int, default=self.STALE,
+            help='retry tasks claimed more than N seconds ago by a worker that died [default: %(default)d]'
+        )
+
+    def handle(self, *args, **options):
+        self.stale = options.get('stale') or self.STALE
+        self.compressed = 0
+        self._lock = threading.Lock()
+        while True:
+            workers = [threading.Thread(target=self.work, name='sftp-delta-{}'.format(i))
+                       for i in range(options.get('concurrency') or self.CONCURRENCY)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if self.compressed or options.get('verbosity', 1) > 1:
+                self.stdout.write('compressed {} versions'.format(self.compressed))
+            self.compressed = 0
+            if not options.get('interval'):
+                break
+            time.sleep(options['interval'])
+
+    def work(self):
+        try:
+            while True:
+                task = models.DeltaTask.claim(stale=self.stale)
+                if task is None:
+                    break
+                try:
+                    compressed = task.run()
+                except Exception:
+                    # left claimed, it is retried once stale
+                    logger.exception('delta compression of {} failed'.format(task.key))
+                    continue
+                if compressed:
+                    with self._lock:
+                        self.compressed += 1
+        finally:
+            connection.close()
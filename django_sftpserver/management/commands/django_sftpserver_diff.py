@@ -0,0 +1,59 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+from django.core.management.base import BaseCommand, CommandError
+from ... import models
+
+
+# the letters of git diff --name-status
+STATUS = {models.ADDED: 'A', models.REMOVED: 'D', models.MODIFIED: 'M'}
+
+
+class Command(BaseCommand):
+    help = 'List the paths which differ between two commits of a root, or a commit and the current files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('root', help='name of the root')
+        parser.add_argument(
+            '--branch', dest='branch', default=None,
+            help='branch of the root'
+        )
+        parser.add_argument(
+            '--from', dest='from', default=None,
+            help='key prefix or id of a commit [default: the base commit]'
+        )
+        parser.add_argument(
+            '--to', dest='to', default=None,
+            help='key prefix or id of a commit [default: the current files]'
+        )
+
+    def get_commit(self, root, value):
+        if value is None:
+            return None
+        # a key prefix may be all digits, so it wins over an id
+        commits = list(models.Commit.objects.filter(root=root, key__startswith=value)[:2])
+        if not commits and value.isdigit():
+            commits = list(models.Commit.objects.filter(root=root, pk=value))
+        if len(commits) != 1:
+            raise CommandError('{} commit {}'.format('ambiguous' if commits else 'unknown', value))
+        return commits[0]
+
+    def handle(self, *args, **options):
+        try:
+            root = models.Root.objects.get(name=options['root'], branch=options.get('branch'))
+        except models.Root.DoesNotExist:
+            raise CommandError('unknown root {}'.format(options['root']))
+        old = self.get_commit(root, options.get('from'))
+        new = self.get_commit(root, options.get('to'))
+        if new is None:
+            records = root.diff(old)
+        else:
+            old = old or root.base_commit
+            if old is None:
+                raise CommandError('--from is required, {} has no base commit'.format(root))
+            records = old.diff(new)
+        for record in records:
+            isdir = (record.new or record.old).isdir
+            self.stdout.write('{} {}{}'.format(STATUS[record.status], record.path, '/' if isdir else ''))
@@ -0,0 +1,36 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import time
+
+from django.core.management.base import BaseCommand
+from ... import models
+
+
+class Command(BaseCommand):
+    help = 'Delete the directories removed with SFTPSERVER_DEFERRED_DELETE'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit', dest='limit', type=int, default=None,
+            help='stop after deleting N files'
+        )
+        parser.add_argument(
+            '--batch-size', dest='batch_size', type=int, default=1000,
+            help='files deleted per statement [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--interval', dest='interval', type=int, default=0,
+            help='keep running and purge every N seconds, 0 runs once [default: %(default)d]'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            count = models.MetaFile.purge(limit=options.get('limit'), batch_size=options['batch_size'])
+            if count or options.get('verbosity', 1) > 1:
+                self.stdout.write('deleted {} files'.format(count))
+            if not options.get('interval'):
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,39 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import time
+
+from django.core.management.base import BaseCommand
+from ... import conf, models
+
+
+class Command(BaseCommand):
+    help = 'Store keyframes in delta chains deeper than SFTPSERVER_MAX_DELTA_DEPTH'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-depth', dest='max_depth', type=int, default=None,
+            help='maximum chain depth [default: SFTPSERVER_MAX_DELTA_DEPTH]'
+        )
+        parser.add_argument(
+            '--limit', dest='limit', type=int, default=None,
+            help='stop after storing N keyframes'
+        )
+        parser.add_argument(
+            '--interval', dest='interval', type=int, default=0,
+            help='keep running and look for deep chains every N seconds, 0 runs once [default: %(default)d]'
+        )
+
+    def handle(self, *args, **options):
+        max_depth = options.get('max_depth')
+        if max_depth is None:
+            max_depth = conf.get('MAX_DELTA_DEPTH')
+        while True:
+            count = models.Data.rebase_chains(max_depth=max_depth, limit=options.get('limit'))
+            if count or options.get('verbosity', 1) > 1:
+                self.stdout.write('stored {} keyframes'.format(count))
+            if not options.get('interval'):
+                break
+            time.sleep(options['interval'])
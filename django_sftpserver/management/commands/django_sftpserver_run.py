@@ -8,9 +8,12 @@ import socket
 import paramiko
 import time
 import os
+import signal
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from ... import sftpserver, storage_sftpserver
+from ...server import HandshakePool, SessionRegistry, load_host_key
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +21,25 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     HOST = '0.0.0.0'
     PORT = '2222'
+    BACKLOG = 128
+    ACCEPT_TIMEOUT = 30
+    MAX_HANDSHAKES = 16
+    MAX_SESSIONS = 0
+    POLL_INTERVAL = 1
+    WORKERS = 0
+    WORKER_SESSIONS = 0
+    IDLE_TIMEOUT = 0
+    MAX_LIFETIME = 0
+    DRAIN_TIMEOUT = 30
+    ENGINE = 'thread'
+    MAX_THREADS = 32
+    # a worker failing within MIN_WORKER_UPTIME seconds is respawned after
+    # RESPAWN_DELAY seconds, doubled on every failure up to RESPAWN_MAX_DELAY
+    MIN_WORKER_UPTIME = 10
+    RESPAWN_DELAY = 1
+    RESPAWN_MAX_DELAY = 60
+    # write end of the pipe a forked worker reports on when it stops accepting
+    recycle_fd = None
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -33,13 +55,64 @@ class Command(BaseCommand):
             help='Debug level: WARNING, INFO, DEBUG [default: %(default)s]'
         )
         parser.add_argument(
-            '-k', '--keyfile', dest='keyfile', metavar='FILE',
-            help='Path to private key, for example /tmp/test_rsa.key'
+            '-k', '--keyfile', dest='keyfile', metavar='FILE', action='append',
+            help='Path to a private host key (RSA, ECDSA or Ed25519), for example /tmp/test_rsa.key. '
+            'May be given several times to offer every key to clients'
         )
         parser.add_argument(
             '--storage-mode', action="store_true",
         )
         parser.add_argument('--socket-filename')
+        parser.add_argument(
+            '--backlog', dest='backlog', type=int, default=self.BACKLOG,
+            help='listen queue size [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--accept-timeout', dest='accept_timeout', type=int, default=self.ACCEPT_TIMEOUT,
+            help='seconds a client may take to open a channel [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--max-handshakes', dest='max_handshakes', type=int, default=self.MAX_HANDSHAKES,
+            help='maximum number of concurrent key exchanges [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--max-sessions', dest='max_sessions', type=int, default=self.MAX_SESSIONS,
+            help='maximum number of established sessions, 0 means unlimited [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--idle-timeout', dest='idle_timeout', type=int, default=self.IDLE_TIMEOUT,
+            help='close sessions without SFTP activity for N seconds, 0 means never [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--max-lifetime', dest='max_lifetime', type=int, default=self.MAX_LIFETIME,
+            help='close sessions older than N seconds, 0 means never [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--drain-timeout', dest='drain_timeout', type=int, default=self.DRAIN_TIMEOUT,
+            help='on shutdown, seconds to wait for active sessions before closing them [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--workers', dest='workers', type=int, default=self.WORKERS,
+            help='number of forked worker processes, 0 serves from this process [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--worker-sessions', dest='worker_sessions', type=int, default=self.WORKER_SESSIONS,
+            help='recycle a worker after it accepted N sessions, 0 means never. A recycled worker is '
+            'replaced at once and serves its sessions until they end [default: %(default)d]'
+        )
+        parser.add_argument(
+            '--reuse-port', dest='reuse_port', action='store_true',
+            help='let every worker bind its own socket with SO_REUSEPORT'
+        )
+        parser.add_argument(
+            '--engine', dest='engine', choices=('thread', 'asyncio'), default=self.ENGINE,
+            help='thread: one paramiko transport thread per session, '
+            'asyncio: asyncssh event loop (requires asyncssh) [default: %(default)s]'
+        )
+        parser.add_argument(
+            '--max-threads', dest='max_threads', type=int, default=self.MAX_THREADS,
+            help='asyncio engine: maximum number of concurrent blocking calls [default: %(default)d]'
+        )
 
     def handle(self, *args, **options):
         self.cont = True
@@ -47,6 +120,43 @@ class Command(BaseCommand):
         paramiko_level = getattr(paramiko.common, options['level'])
         paramiko.common.logging.basicConfig(level=paramiko_level)
 
+        workers = options.get('workers') or self.WORKERS
+        if options.get('reuse_port'):
+            if options['socket_filename']:
+                raise CommandError('--reuse-port can not be used with --socket-filename')
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise CommandError('SO_REUSEPORT is not supported on this platform')
+            if not workers:
+                raise CommandError('--reuse-port requires --workers')
+        if workers and not hasattr(os, 'fork'):
+            raise CommandError('--workers is not supported on this platform')
+        if options.get('engine', self.ENGINE) == 'asyncio':
+            try:
+                import asyncssh  # NOQA
+            except ImportError:
+                raise CommandError('--engine asyncio requires asyncssh')
+
+        # parsed once here, every transport (and every forked worker) shares them
+        self.host_keys = self.load_host_keys(options)
+
+        if options['storage_mode']:
+            self.sftpserver_module = storage_sftpserver
+        else:
+            self.sftpserver_module = sftpserver
+
+        if not workers:
+            try:
+                signal.signal(signal.SIGTERM, self.stop)
+            except ValueError:
+                # not running in the main thread
+                pass
+            self.serve(self.bind(options), options)
+        elif options.get('reuse_port'):
+            self.prefork(None, workers, options)
+        else:
+            self.prefork(self.bind(options), workers, options)
+
+    def bind(self, options, reuse_port=False):
         if options['socket_filename']:
             server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             if os.path.exists(options['socket_filename']):
@@ -55,38 +165,213 @@ class Command(BaseCommand):
         else:
             server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+            if reuse_port:
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
             server_socket.bind((options['host'], options['port']))
-        server_socket.listen(10)
+        server_socket.listen(options.get('backlog') or self.BACKLOG)
+        # wake up regularly so that a cleared ``cont`` is noticed without a new connection
+        server_socket.settimeout(self.POLL_INTERVAL)
+        return server_socket
 
-        if options['storage_mode']:
-            sftpserver_module = storage_sftpserver
-        else:
-            sftpserver_module = sftpserver
+    def transport_factory(self, options):
+        sftpserver_module = self.sftpserver_module
+
+        def factory(conn, addr):
+            transport = paramiko.Transport(conn)
+            for host_key in self.host_keys:
+                transport.add_server_key(host_key)
+            transport.set_subsystem_handler(
+                'sftp', paramiko.SFTPServer, sftpserver_module.StubSFTPServer)
+            return transport, sftpserver_module.StubServer(addr)
+        return factory
+
+    def load_host_keys(self, options):
+        host_keys = []
+        if options.get('pkey'):
+            host_keys.append(options['pkey'])
+        keyfiles = options.get('keyfile') or []
+        if not isinstance(keyfiles, (list, tuple)):
+            keyfiles = [keyfiles]
+        # asyncssh reads the files itself, paramiko can not export every key type
+        self.host_keyfiles = host_keys[:] + list(keyfiles)
+        for filename in keyfiles:
+            try:
+                host_key = load_host_key(filename)
+            except (IOError, paramiko.SSHException) as e:
+                raise CommandError('can not load host key {}: {}'.format(filename, e))
+            logger.info('loaded {} host key {}'.format(host_key.get_name(), filename))
+            host_keys.append(host_key)
+        if not host_keys:
+            raise CommandError('at least one host key is required, use --keyfile')
+        return host_keys
 
-        transport_list = []
+    def stop(self, signum=None, frame=None):
+        self.cont = False
+
+    def recycling(self):
+        '''the worker stopped accepting, the parent can start its replacement'''
+        if self.recycle_fd is not None:
+            os.write(self.recycle_fd, '{}\n'.format(os.getpid()).encode('ascii'))
+
+    def serve(self, server_socket, options, worker=False):
+        if options.get('engine', self.ENGINE) == 'asyncio':
+            return self.serve_asyncio(server_socket, options, worker=worker)
+        sessions = SessionRegistry(
+            idle_timeout=options.get('idle_timeout') or self.IDLE_TIMEOUT,
+            max_lifetime=options.get('max_lifetime') or self.MAX_LIFETIME)
+        sessions.start()
+        pool = HandshakePool(
+            self.transport_factory(options),
+            max_handshakes=options.get('max_handshakes') or self.MAX_HANDSHAKES,
+            max_sessions=options.get('max_sessions') or self.MAX_SESSIONS,
+            accept_timeout=int(options.get('accept_timeout') or self.ACCEPT_TIMEOUT),
+            sessions=sessions)
+        worker_sessions = (options.get('worker_sessions') or self.WORKER_SESSIONS) if worker else 0
+        accepted = 0
         try:
             while self.cont:
                 try:
-                    conn, addr = server_socket.accept()
+                    try:
+                        conn, addr = server_socket.accept()
+                    except socket.timeout:
+                        continue
                     if not self.cont:
+                        conn.close()
                         break
-                    if options.get('pkey'):
-                        host_key = options['pkey']
-                    else:
-                        host_key = paramiko.RSAKey.from_private_key_file(options['keyfile'])
-                    transport = paramiko.Transport(conn)
-                    transport.add_server_key(host_key)
-                    transport.set_subsystem_handler(
-                        'sftp', paramiko.SFTPServer, sftpserver_module.StubSFTPServer)
-                    server = sftpserver_module.StubServer(addr)
-                    transport.start_server(server=server)
-                    channel = transport.accept(timeout=int(options.get('accept_timeout')))
-
-                    transport_list.append((transport, channel))
-                except:
+                    if pool.submit(conn, addr):
+                        accepted += 1
+                    if worker_sessions and accepted >= worker_sessions:
+                        logger.info('worker {} served {} sessions, recycling'.format(os.getpid(), accepted))
+                        break
+                except Exception:
                     logger.exception("server error")
+        except KeyboardInterrupt:
+            self.cont = False
+        finally:
+            server_socket.close()
+            drain_timeout = options.get('drain_timeout', self.DRAIN_TIMEOUT)
+            deadline = time.time() + drain_timeout
+            if self.cont:
+                # recycled, the accepted connections are completed and the
+                # sessions are not cut off until a shutdown
+                self.recycling()
+                pool.shutdown(wait=True)
+                while self.cont and sessions.reap():
+                    time.sleep(self.POLL_INTERVAL)
+                deadline = time.time() + drain_timeout
+            else:
+                # let running handshakes finish before draining their sessions
+                pool.shutdown(wait=True, timeout=drain_timeout, drop_pending=True)
+            sessions.drain(max(0, deadline - time.time()), poll_interval=self.POLL_INTERVAL)
+            sessions.stop()
 
+    def serve_asyncio(self, server_socket, options, worker=False):
+        from ...asyncio_sftpserver import AsyncioEngine
+        engine = AsyncioEngine(
+            self.sftpserver_module, self.host_keyfiles,
+            max_threads=options.get('max_threads') or self.MAX_THREADS,
+            max_sessions=options.get('max_sessions') or self.MAX_SESSIONS,
+            accept_timeout=int(options.get('accept_timeout') or self.ACCEPT_TIMEOUT),
+            max_accepted=(options.get('worker_sessions') or self.WORKER_SESSIONS) if worker else 0,
+            idle_timeout=options.get('idle_timeout') or self.IDLE_TIMEOUT,
+            max_lifetime=options.get('max_lifetime') or self.MAX_LIFETIME,
+            drain_timeout=options.get('drain_timeout', self.DRAIN_TIMEOUT))
+        try:
+            engine.serve(server_socket, lambda: self.cont, poll_interval=self.POLL_INTERVAL,
+                         recycling=self.recycling)
         except KeyboardInterrupt:
-            for transport, channel in transport_list:
-                while transport.is_active():
-                    time.sleep(1)
+            pass
+
+    def prefork(self, server_socket, workers, options):
+        # forked children must not share the parent's database connections
+        connections.close_all()
+        # pid: start time
+        children = {}
+        # recycled workers still serving their last sessions, already replaced
+        draining = set()
+        # times the exited workers are due to be respawned
+        respawns = []
+        failures = 0
+        recycled_fd, self.recycle_fd = os.pipe()
+        os.set_blocking(recycled_fd, False)
+        recycled = b''
+
+        def spawn():
+            pid = os.fork()
+            if pid:
+                children[pid] = time.time()
+                return
+            status = 0
+            try:
+                os.close(recycled_fd)
+                signal.signal(signal.SIGTERM, self.stop)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self.serve(server_socket or self.bind(options, reuse_port=True), options, worker=True)
+            except Exception:
+                logger.exception('worker {} error'.format(os.getpid()))
+                status = 1
+            finally:
+                os._exit(status)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(workers):
+            spawn()
+        while self.cont:
+            try:
+                recycled += os.read(recycled_fd, 4096)
+            except OSError:
+                # nothing written, or interrupted by a signal
+                pass
+            lines = recycled.split(b'\n')
+            recycled = lines.pop()
+            for pid in (int(x) for x in lines):
+                if pid in children:
+                    del children[pid]
+                    draining.add(pid)
+                    logger.info('worker {} is recycled, respawning'.format(pid))
+                    respawns.append(time.time())
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                # every worker is waiting to be respawned
+                pid = 0
+            if pid in draining:
+                draining.discard(pid)
+                continue
+            if pid:
+                started_at = children.pop(pid, time.time())
+                if self.cont:
+                    # a worker failing at startup (bind error, database down) is not respawned at once
+                    if status and time.time() - started_at < self.MIN_WORKER_UPTIME:
+                        delay = min(self.RESPAWN_MAX_DELAY, self.RESPAWN_DELAY * 2 ** failures)
+                        failures += 1
+                    else:
+                        delay = 0
+                        failures = 0
+                    logger.info('worker {} exited with status {}, respawning in {}s'.format(pid, status, delay))
+                    respawns.append(time.time() + delay)
+                continue
+            now = time.time()
+            due = [x for x in respawns if x <= now]
+            if due:
+                respawns = [x for x in respawns if x > now]
+                for _ in due:
+                    spawn()
+            else:
+                time.sleep(self.POLL_INTERVAL)
+
+        remaining = list(children) + list(draining)
+        for pid in remaining:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in remaining:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        os.close(recycled_fd)
+        os.close(self.recycle_fd)
+        self.recycle_fd = None
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.2.25 on 2026-10-18 07:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sftpserver', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Chunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True)),
+                ('size', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='chunked',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='data',
+            name='size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='DataChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('offset', models.BigIntegerField()),
+                ('size', models.IntegerField()),
+                ('chunk_key', models.CharField(max_length=40)),
+                ('data', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='django_sftpserver.data')),
+            ],
+            options={
+                'unique_together': {('data', 'index')},
+                'index_together': {('data', 'offset')},
+            },
+        ),
+    ]
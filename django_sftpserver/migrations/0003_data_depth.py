@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.2.25 on 2026-10-18 07:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_depth(apps, schema_editor):
+    Data = apps.get_model('django_sftpserver', 'Data')
+    keys = list(Data.objects.filter(parent_key__isnull=True).values_list('key', flat=True))
+    depth = 0
+    while keys:
+        depth += 1
+        qs = Data.objects.filter(parent_key__in=keys)
+        keys = list(qs.values_list('key', flat=True))
+        qs.update(depth=depth)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sftpserver', '0002_chunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='depth',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(set_depth, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.2.25 on 2026-10-18 07:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sftpserver', '0003_data_depth'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeltaTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True)),
+                ('parent_key', models.CharField(max_length=40)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
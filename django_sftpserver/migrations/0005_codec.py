@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.2.25 on 2026-10-18 07:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sftpserver', '0004_deltatask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='codec',
+            field=models.CharField(choices=[('none', 'none'), ('zlib', 'zlib'), ('lzma', 'lzma'), ('bz2', 'bz2')], default='none', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='codec',
+            field=models.CharField(choices=[('none', 'none'), ('zlib', 'zlib'), ('lzma', 'lzma'), ('bz2', 'bz2')], default='none', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='root',
+            name='codec',
+            field=models.CharField(blank=True, choices=[('none', 'none'), ('zlib', 'zlib'), ('lzma', 'lzma'), ('bz2', 'bz2')], max_length=8, null=True),
+        ),
+    ]
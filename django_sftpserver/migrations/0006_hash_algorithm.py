@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.2.25 on 2026-10-18 07:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sftpserver', '0005_codec'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='algorithm',
+            field=models.CharField(default='sha1', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='algorithm',
+            field=models.CharField(default='sha1', max_length=16),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.2.25 on 2026-10-18 07:47
+from __future__ import unicode_literals
+
+import stat
+
+from django.db import migrations, models
+from django.db.models import F
+
+FILE_MODE = stat.S_IFREG | stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
+DIR_MODE = stat.S_IFDIR | stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP
+
+
+def fill_stat(apps, schema_editor):
+    Data = apps.get_model('django_sftpserver', 'Data')
+    MetaFile = apps.get_model('django_sftpserver', 'MetaFile')
+    CommitItem = apps.get_model('django_sftpserver', 'CommitItem')
+    MetaFile.objects.filter(key__isnull=True).update(mode=DIR_MODE, mtime=F('created_at'))
+    for model in (MetaFile, CommitItem):
+        model.objects.filter(key__isnull=False).update(mode=FILE_MODE)
+    for key, size, created_at in Data.objects.values_list('key', 'size', 'created_at').iterator():
+        for model in (MetaFile, CommitItem):
+            model.objects.filter(key=key).update(size=size or 0, mtime=created_at)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sftpserver', '0006_hash_algorithm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commititem',
+            name='mode',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='commititem',
+            name='mtime',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='commititem',
+            name='size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='metafile',
+            name='mode',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='metafile',
+            name='mtime',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='metafile',
+            name='size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_stat, migrations.RunPython.noop),
+    ]
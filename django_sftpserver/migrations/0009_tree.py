@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.2.25 on 2026-10-18 07:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_sftpserver.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sftpserver', '0008_metafile_detached'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tree',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True)),
+                ('algorithm', models.CharField(default='sha1', max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='commit',
+            name='tree_key',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.CreateModel(
+            name='TreeEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=1024)),
+                ('key', models.CharField(blank=True, max_length=40, null=True)),
+                ('tree_key', models.CharField(blank=True, max_length=40, null=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('mtime', models.DateTimeField(blank=True, null=True)),
+                ('mode', models.IntegerField(default=0)),
+                ('tree', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='django_sftpserver.tree')),
+            ],
+            options={
+                'unique_together': {('tree', 'name')},
+            },
+            bases=(django_sftpserver.models.MetaFileMixin, models.Model),
+        ),
+    ]
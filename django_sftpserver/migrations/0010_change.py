@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.2.25 on 2026-10-18 07:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sftpserver', '0009_tree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commit',
+            name='change_seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='root',
+            name='change_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.BigIntegerField()),
+                ('path', models.CharField(max_length=4096)),
+                ('root', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='django_sftpserver.root')),
+            ],
+            options={
+                'index_together': {('root', 'seq')},
+            },
+        ),
+    ]
@@ -4,23 +4,51 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 import os
+import copy
 import six
-import hashlib
+import collections
 import bsdiff4
 import stat as _stat
 import time as _time
+import uuid
 import yaml
+from datetime import timedelta
 
 from django.conf import settings
 from django.contrib.auth.models import Group
 from django.core.cache import cache
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Case, When, Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
 from future.utils import python_2_unicode_compatible
 from django.utils.module_loading import import_string
 from django.core.files.storage import default_storage
 
 from django.utils.encoding import force_bytes
 
+from . import conf, compression
+from .blob import SpooledBlob, new_hash, hexdigest
+from .blobcache import get_blob_cache
+from .chunking import Chunker
+
+
+FILE_MODE = _stat.S_IFREG | _stat.S_IRUSR | _stat.S_IWUSR | _stat.S_IRGRP | _stat.S_IWGRP
+DIR_MODE = _stat.S_IFDIR | _stat.S_IRWXU | _stat.S_IRGRP | _stat.S_IWGRP | _stat.S_IXGRP
+
+# number of chunks held in memory and inserted per query
+CHUNK_BATCH_SIZE = 16
+# number of trees looked up or inserted per query
+TREE_BATCH_SIZE = 500
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+# a path of a diff, old or new is the TreeEntry before or after the change
+DiffRecord = collections.namedtuple('DiffRecord', ('status', 'path', 'old', 'new'))
+
 
 def _timestamp(dt):
     if dt is None:
@@ -45,14 +73,58 @@ class AuthorizedKey(models.Model):
         return 'AuthorizedKey({})'.format(self.name)
 
 
+PERMISSION_VERSION_KEY = 'django_sftpserver:permission_version'
+
+
+def _new_permission_version():
+    # never reused, so an evicted version can not revive stale permission sets
+    return uuid.uuid4().hex
+
+
+def _permission_version():
+    version = cache.get(PERMISSION_VERSION_KEY)
+    if version is None:
+        version = _new_permission_version()
+        if not cache.add(PERMISSION_VERSION_KEY, version, None):
+            # another process set it first
+            version = cache.get(PERMISSION_VERSION_KEY, version)
+    return version
+
+
+class PermissionMixin(object):
+    '''access through the users relation or the groups relation'''
+
+    @classmethod
+    def accessible_ids(klass, user):
+        '''ids of the objects the user can access, cached until a membership changes'''
+        key = 'django_sftpserver:{}:{}:{}'.format(klass._meta.model_name, user.pk, _permission_version())
+        ids = cache.get(key)
+        if ids is None:
+            qs = klass.objects.filter(users=user).values_list('id', flat=True)
+            ids = set(qs.union(klass.objects.filter(groups__user=user).values_list('id', flat=True)))
+            cache.set(key, ids, conf.get('PERMISSION_CACHE_TIMEOUT'))
+        return ids
+
+    @classmethod
+    def accessible_by(klass, user):
+        return klass.objects.filter(id__in=klass.accessible_ids(user))
+
+    def has_permission(self, user):
+        return self.pk in self.accessible_ids(user)
+
+
 @python_2_unicode_compatible
-class Root(models.Model):
+class Root(PermissionMixin, models.Model):
     name = models.CharField(max_length=256)
     branch = models.CharField(max_length=256, blank=True, null=True)
     users = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True)
     groups = models.ManyToManyField(Group, blank=True)
     base_commit = models.ForeignKey("Commit", blank=True, null=True,
                                     on_delete=models.SET_NULL, related_name='+')
+    # codec of the versions stored through this root, SFTPSERVER_CODEC when empty
+    codec = models.CharField(max_length=8, choices=compression.CODEC_CHOICES, blank=True, null=True)
+    # bumped by every change, see Change
+    change_seq = models.BigIntegerField(default=0)
 
     class Meta:
         unique_together = (('name', 'branch', ))
@@ -63,8 +135,12 @@ class Root(models.Model):
             branch = '-' + self.branch
         return 'root({}{})'.format(self.name, branch)
 
-    def has_permission(self, user):
-        return bool(user in self.users.all())
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not kwargs.get('update_fields'):
+            # change_seq is only updated in the database, the instance may be stale
+            kwargs['update_fields'] = [x.name for x in self._meta.concrete_fields
+                                       if not x.primary_key and x.name != 'change_seq']
+        super(Root, self).save(*args, **kwargs)
 
     def ls(self, path):
         if path != '/' and path.endswith('/'):
@@ -74,13 +150,41 @@ class Root(models.Model):
         fileobj = self.get(path)
         return MetaFile.objects.filter(parent=fileobj)
 
+    def listdir(self, path):
+        '''stat of every entry of a directory (with a filename attribute), in one query'''
+        if path != '/' and path.endswith('/'):
+            path = path[:-1]
+        result = []
+        Stat = MetaFile.Stat
+        for filename, key, size, mtime, mode, accessed_at in MetaFile.objects.filter(
+                root=self, parent__path=path).values_list(
+                    'filename', 'key', 'size', 'mtime', 'mode', 'accessed_at').iterator():
+            s = Stat()
+            s.filename = filename
+            s.st_size = 0 if key is None else size
+            s.st_uid = 0
+            s.st_gid = 0
+            s.st_mode = mode or (DIR_MODE if key is None else FILE_MODE)
+            s.st_atime = _timestamp(accessed_at)
+            s.st_mtime = _timestamp(mtime)
+            result.append(s)
+        # only an empty result needs to tell an empty directory from a missing one
+        if not result and not self.exists(path):
+            if path != '/':
+                raise MetaFile.DoesNotExist(path)
+            self.mkdir(path)
+        return result
+
     def exists(self, path):
         return MetaFile.objects.filter(root=self, path=path).exists()
 
     def get(self, path):
         if path != '/' and path.endswith('/'):
             path = path[:-1]
-        return MetaFile.objects.get(root=self, path=path)
+        fileobj = MetaFile.objects.get(root=self, path=path)
+        # the codec of a write is read from the root without a query
+        fileobj.root = self
+        return fileobj
 
     def create(self, path):
         dirname, basename = os.path.split(path)
@@ -98,6 +202,7 @@ class Root(models.Model):
             root=self, parent=parent, path=path, filename=basename)
         if not created and fileobj.key is None:
             raise Exception()
+        fileobj.root = self
         fileobj.data = content
         fileobj.save()
         return fileobj
@@ -108,7 +213,16 @@ class Root(models.Model):
 
     def remove(self, path):
         fileobj = self.get(path)
-        fileobj.delete()
+        with transaction.atomic():
+            Change.record(self.pk, [fileobj.path])
+            if fileobj.isdir and conf.get('DEFERRED_DELETE'):
+                # detached from the root at once, deleted by MetaFile.purge
+                MetaFile.subtree(self.pk, fileobj.path).update(root=None)
+                MetaFile.objects.filter(pk=fileobj.pk).update(root=None, parent=None)
+                return
+            if fileobj.isdir:
+                MetaFile.delete_rows(MetaFile.subtree(self.pk, fileobj.path))
+            fileobj.delete()
 
     def rename(self, oldpath, newpath):
         fileobj = self.get(oldpath)
@@ -117,10 +231,14 @@ class Root(models.Model):
 
         if newpath.endswith('/'):
             newpath = newpath[:-1]
+        if newpath.startswith(fileobj.path + '/'):
+            # into its own subtree
+            raise Exception()
         newdirname, newbasename = os.path.split(newpath)
-        fileobj.parent = self.mkdir_if_not_exists(newdirname)
-        fileobj.filename = newbasename
-        fileobj.update_path()
+        with transaction.atomic():
+            fileobj.parent = self.mkdir_if_not_exists(newdirname)
+            fileobj.filename = newbasename
+            fileobj.update_path()
         return fileobj
 
     def mkdir(self, path):
@@ -129,62 +247,257 @@ class Root(models.Model):
         return self.mkdir_if_not_exists(path)
 
     def mkdir_if_not_exists(self, path):
-        qs = MetaFile.objects.filter(root=self, path=path)
-        if qs.exists():
-            return qs[0]
-
-        if path == '/':
-            return MetaFile.objects.create(root=self, filename='', path=path)
-
-        if path.endswith('/'):
+        if path != '/' and path.endswith('/'):
             path = path[:-1]
-        dirname, basename = os.path.split(path)
-        parent = self.mkdir_if_not_exists(dirname)
-        return MetaFile.objects.create(root=self, parent=parent, filename=basename, path=path)
+        # the directory and all of its ancestors
+        paths = ['/']
+        for name in path.split('/'):
+            if name:
+                paths.append(os.path.join(paths[-1], name))
+        for _ in range(3):
+            existing = {x.path: x for x in MetaFile.objects.filter(root=self, path__in=paths)}
+            if paths[-1] in existing:
+                return existing[paths[-1]]
+            try:
+                with transaction.atomic():
+                    return self._mkdirs(paths, existing)
+            except IntegrityError:
+                # created concurrently by another session
+                continue
+        return MetaFile.objects.get(root=self, path=paths[-1])
+
+    def _mkdirs(self, paths, existing):
+        now = timezone.now()
+        missing = [x for x in paths if x not in existing]
+        MetaFile.objects.bulk_create([
+            MetaFile(root=self, path=x, filename=os.path.basename(x), mode=DIR_MODE, mtime=now)
+            for x in missing])
+        # primary keys are not returned by every backend, parents are set afterwards
+        created = {x.path: x for x in MetaFile.objects.filter(root=self, path__in=missing)}
+        existing.update(created)
+        parents = {}
+        for parent_path, path in zip(paths, paths[1:]):
+            if path in created:
+                created[path].parent_id = parents[created[path].pk] = existing[parent_path].pk
+        if parents:
+            MetaFile.objects.filter(pk__in=list(parents)).update(parent=Case(
+                *[When(pk=k, then=Value(v)) for k, v in parents.items()], output_field=models.IntegerField()))
+        Change.record(self.pk, missing)
+        return existing[paths[-1]]
+
+    def changes(self, since=None):
+        '''paths changed (or removed, with their content) after the change_seq since, or the base commit'''
+        if since is None:
+            since = self.base_commit.change_seq if self.base_commit else 0
+        return Change.objects.filter(root=self, seq__gt=since).values_list('path', flat=True).distinct()
+
+    def trees(self, base_commit=None):
+        '''
+        (key of the root tree, {key: entries}) of the current files, nothing
+        is stored. Only the directories along the paths changed after
+        base_commit are hashed again when its change_seq is known.
+        '''
+        if base_commit is None or base_commit.change_seq is None:
+            return Tree.build(MetaFile.objects.filter(root=self).values_list(
+                'path', 'key', 'size', 'mtime', 'mode').iterator())
+        affected = {'/'}
+        for path in self.changes(base_commit.change_seq).iterator():
+            # the ancestors of an affected directory are affected
+            while path not in affected:
+                affected.add(path)
+                path = os.path.dirname(path)
+
+        children = {}
+        dirs = ['/']
+        paths = list(affected)
+        for i in range(0, len(paths), TREE_BATCH_SIZE):
+            for path, key, size, mtime, mode in MetaFile.objects.filter(
+                    root=self, parent__path__in=paths[i:i + TREE_BATCH_SIZE]).values_list(
+                        'path', 'key', 'size', 'mtime', 'mode').iterator():
+                entry = TreeEntry(name=os.path.basename(path), key=key, size=0 if key is None else size,
+                                  mtime=mtime, mode=mode or (DIR_MODE if key is None else FILE_MODE))
+                children.setdefault(os.path.dirname(path), []).append((path, entry))
+                if key is None and path in affected:
+                    dirs.append(path)
+
+        # entries of the affected directories in the base commit, one query per level
+        base_entries = {}
+        level = {'/': base_commit.get_tree_key()}
+        while level:
+            by_key = {}
+            keys = list(set(level.values()))
+            for i in range(0, len(keys), TREE_BATCH_SIZE):
+                for entry in TreeEntry.objects.filter(
+                        tree__key__in=keys[i:i + TREE_BATCH_SIZE]).select_related('tree'):
+                    by_key.setdefault(entry.tree.key, {})[entry.name] = entry
+            next_level = {}
+            for path, key in level.items():
+                base_entries[path] = by_key.get(key, {})
+                for name, entry in base_entries[path].items():
+                    child_path = os.path.join(path, name)
+                    if entry.isdir and child_path in affected:
+                        next_level[child_path] = entry.tree_key
+            level = next_level
+
+        tree_keys = {}
+        trees = {}
+        for path in sorted(dirs, key=lambda x: x.count('/') if x != '/' else 0, reverse=True):
+            entries = []
+            for child_path, entry in children.get(path, []):
+                if entry.isdir:
+                    old = base_entries.get(path, {}).get(entry.name)
+                    if child_path in affected:
+                        entry.tree_key = tree_keys[child_path]
+                    elif old is not None and old.isdir:
+                        # unchanged since the base commit
+                        entry.tree_key = old.tree_key
+                    else:
+                        # moved here, hashed from scratch
+                        entry.tree_key, subtrees = Tree.build(
+                            ('/' + x[0][len(child_path) + 1:],) + tuple(x[1:])
+                            for x in MetaFile.subtree(self.pk, child_path).values_list(
+                                'path', 'key', 'size', 'mtime', 'mode').iterator())
+                        trees.update(subtrees)
+                entries.append(entry)
+            tree_keys[path] = Tree.hash(entries)
+            trees[tree_keys[path]] = entries
+        return tree_keys['/'], trees
+
+    def diff(self, commit=None):
+        '''
+        yield a DiffRecord for every path which differs between commit (the
+        base commit by default) and the current files
+        '''
+        # no row lock, writers are not held up. The journal is read against
+        # the base commit it follows, a commit in between prunes it, so the
+        # trees are read again after one
+        base = Root.objects.select_related('base_commit').get(pk=self.pk).base_commit
+        while True:
+            new_key, trees = self.trees(base)
+            current = Root.objects.select_related('base_commit').get(pk=self.pk).base_commit
+            if current == base:
+                break
+            base = current
+        commit = commit or base
+        if commit is None:
+            old_key = Tree.hash([])
+            trees[old_key] = []
+        else:
+            old_key = commit.get_tree_key()
+        return Tree.records(old_key, new_key, trees)
+
+    def checkout(self, commit):
+        '''
+        make the files equal to the ones of commit, which becomes the base
+        commit. Uncommitted changes are lost. Only the differences are
+        written, in bulk, and the versions are shared by key.
+        '''
+        if commit.root_id != self.pk:
+            raise ValueError('{} is not a commit of {}'.format(commit, self))
+        target_key = commit.get_tree_key()
+        with transaction.atomic():
+            locked = Root.objects.select_for_update().select_related('base_commit').get(pk=self.pk)
+            current_key, trees = self.trees(locked.base_commit)
+            removed = []
+            modified = {}
+            added = []
+            for path, old, new in Tree.diff(current_key, target_key, trees, expand_added=True):
+                if new is None:
+                    removed.append(path)
+                elif old is None:
+                    added.append((path, new))
+                else:
+                    modified[path] = new
+
+            for path in removed:
+                MetaFile.delete_rows(MetaFile.subtree(self.pk, path))
+            for i in range(0, len(removed), TREE_BATCH_SIZE):
+                MetaFile.delete_rows(MetaFile.objects.filter(root=self, path__in=removed[i:i + TREE_BATCH_SIZE]))
+
+            paths = list(modified)
+            for i in range(0, len(paths), TREE_BATCH_SIZE):
+                fileobjs = list(MetaFile.objects.filter(root=self, path__in=paths[i:i + TREE_BATCH_SIZE]))
+                for fileobj in fileobjs:
+                    entry = modified[fileobj.path]
+                    fileobj.key, fileobj.size, fileobj.mtime, fileobj.mode = (
+                        entry.key, entry.size, entry.mtime, entry.mode)
+                MetaFile.objects.bulk_update(fileobjs, ['key', 'size', 'mtime', 'mode'])
+
+            # a level at a time, the parents of a level exist once the previous one is inserted
+            levels = {}
+            for path, entry in added:
+                levels.setdefault(path.count('/'), []).append((path, entry))
+            self.mkdir_if_not_exists('/')
+            for depth in sorted(levels):
+                parents = list(set(os.path.dirname(x) for x, _ in levels[depth]))
+                parent_ids = {}
+                for i in range(0, len(parents), TREE_BATCH_SIZE):
+                    parent_ids.update(MetaFile.objects.filter(
+                        root=self, path__in=parents[i:i + TREE_BATCH_SIZE]).values_list('path', 'id'))
+                MetaFile.objects.bulk_create([
+                    MetaFile(root=self, parent_id=parent_ids[os.path.dirname(path)], path=path,
+                             filename=entry.name, key=entry.key, size=entry.size,
+                             mtime=entry.mtime, mode=entry.mode)
+                    for path, entry in levels[depth]], batch_size=TREE_BATCH_SIZE)
+
+            # the journal starts again from the commit
+            change_seq = locked.change_seq if commit.change_seq is None else commit.change_seq
+            Change.objects.filter(root=self).delete()
+            Root.objects.filter(pk=self.pk).update(base_commit=commit, change_seq=change_seq)
+            self.base_commit = commit
+            self.change_seq = change_seq
 
     @property
     def dirty(self):
-        if not self.base_commit:
+        '''one query, unless the base commit was made before the change journal'''
+        if not self.base_commit_id:
             return True
-        commit_items = {x.path: x.key
-                        for x in CommitItem.objects.filter(commit=self.base_commit)}
-        for item in MetaFile.objects.filter(root=self).order_by("path"):
-            value = commit_items.pop(item.path, False)
-            if value is not item.key:
-                return True
-        return bool(commit_items)
+        change_seq, commit_seq = Root.objects.filter(pk=self.pk).values_list(
+            'change_seq', 'base_commit__change_seq').get()
+        if commit_seq is not None:
+            return change_seq != commit_seq
+        tree_key, _ = self.trees()
+        return tree_key != self.base_commit.get_tree_key()
 
     def commit(self):
-        c = Commit.objects.create(root=self, parent_commit=self.base_commit)
-        self.base_commit = c
-        self.save()
-
-        h = hashlib.sha1('{}'.format(_timestamp(c.created_at)).encode('UTF-8'))
-        for item in MetaFile.objects.filter(root=self).order_by("path"):
-            CommitItem.objects.create(commit=c, path=item.path, key=item.key)
-            h.update(item.path.encode('UTF-8'))
-            if item.key:
-                h.update(item.key.encode('UTF-8'))
-        c.key = h.hexdigest()
-        c.save()
+        with transaction.atomic():
+            # changes of other sessions wait for the commit
+            locked = Root.objects.select_for_update().select_related('base_commit').get(pk=self.pk)
+            tree_key, trees = self.trees(locked.base_commit)
+            # only the trees of the changed directories are new
+            Tree.store(trees)
+            c = Commit.objects.create(root=self, parent_commit=locked.base_commit, tree_key=tree_key,
+                                      change_seq=locked.change_seq)
+            Root.objects.filter(pk=self.pk).update(base_commit=c)
+            self.base_commit = c
+            self.change_seq = locked.change_seq
+            # the journal is only read after the base commit
+            Change.objects.filter(root=self, seq__lte=locked.change_seq).delete()
+
+            h = new_hash()
+            h.update('{}'.format(_timestamp(c.created_at)).encode('UTF-8'))
+            h.update(tree_key.encode('UTF-8'))
+            if c.parent_commit and c.parent_commit.key:
+                h.update(c.parent_commit.key.encode('UTF-8'))
+            c.key = h.hexdigest()
+            c.save()
         return c
 
 
 class MetaFileMixin(object):
+    class Stat(object):
+        pass
+
+    # codec of the versions stored through data, None for SFTPSERVER_CODEC
+    codec = None
+
     @property
-    def size(self):
-        key = '{}_size'.format(self.key)
-        value = cache.get(key)
-        if value is None:
-            value = Data.objects.get(key=self.key).size
-        cache.set(key, value, None)
-        return value
+    def isdir(self):
+        return self.key is None
 
     @property
     def modified_at(self):
-        if self.key is None:
-            return self.created_at
-        return Data.objects.get(key=self.key).created_at
+        return self.mtime
 
     @property
     def data(self):
@@ -192,19 +505,34 @@ class MetaFileMixin(object):
 
     @data.setter
     def data(self, value):
-        self.key = Data.put(value, self.key)
+        self.key = Data.put(value, self.key, codec=self.codec)
+        self.size = value.size if isinstance(value, SpooledBlob) else len(value)
+        self.mtime = timezone.now()
+
+    @property
+    def stat(self):
+        s = self.Stat()
+        s.st_size = 0 if self.isdir else self.size
+        s.st_uid = 0
+        s.st_gid = 0
+        s.st_mode = self.mode or (DIR_MODE if self.isdir else FILE_MODE)
+        s.st_atime = _timestamp(getattr(self, 'accessed_at', None))
+        s.st_mtime = _timestamp(self.mtime)
+        return s
 
 
 @python_2_unicode_compatible
 class MetaFile(MetaFileMixin, models.Model):
-    class Stat(object):
-        pass
-
-    root = models.ForeignKey(Root, on_delete=models.CASCADE)
+    # removed subtrees waiting for MetaFile.purge have no root
+    root = models.ForeignKey(Root, on_delete=models.CASCADE, blank=True, null=True)
     parent = models.ForeignKey("self", on_delete=models.CASCADE, blank=True, null=True)
     path = models.CharField(max_length=4096)
     filename = models.CharField(max_length=1024)
     key = models.CharField(max_length=40, blank=True, null=True)
+    # kept up to date on write so that stat does not need any query
+    size = models.BigIntegerField(default=0)
+    mtime = models.DateTimeField(blank=True, null=True)
+    mode = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     accessed_at = models.DateTimeField(blank=True, null=True)
 
@@ -214,37 +542,92 @@ class MetaFile(MetaFileMixin, models.Model):
     def __str__(self):
         return 'MetaFile({})'.format(self.path)
 
-    @property
-    def isdir(self):
-        return self.key is None
+    def save(self, *args, **kwargs):
+        file_type = _stat.S_IFDIR if self.isdir else _stat.S_IFREG
+        if _stat.S_IFMT(self.mode) != file_type:
+            self.mode = DIR_MODE if self.isdir else FILE_MODE
+        if self.mtime is None:
+            self.mtime = timezone.now()
+        with transaction.atomic(savepoint=False):
+            super(MetaFile, self).save(*args, **kwargs)
+            if self.root_id is not None:
+                Change.record(self.root_id, [self.path])
 
     @property
-    def stat(self):
-        s = self.Stat()
-        s.st_size = 0 if self.isdir else self.size
-        s.st_uid = 0
-        s.st_gid = 0
-        s.st_mode = _stat.S_IFDIR if self.isdir else _stat.S_IFREG
-        s.st_mode |= _stat.S_IRUSR | _stat.S_IWUSR | _stat.S_IRGRP | _stat.S_IWGRP
-        if self.isdir:
-            s.st_mode |= _stat.S_IXUSR | _stat.S_IXGRP
-        s.st_atime = _timestamp(self.accessed_at)
-        s.st_mtime = _timestamp(self.modified_at)
-        return s
+    def codec(self):
+        return self.root.codec
+
+    @classmethod
+    def subtree(cls, root_id, path):
+        '''queryset of the descendants of path, without path itself'''
+        prefix = path if path.endswith('/') else path + '/'
+        # LIKE ignores the case on sqlite, the prefix is compared again
+        return cls.objects.filter(root_id=root_id, path__startswith=prefix).annotate(
+            path_prefix=Substr('path', 1, len(prefix))).filter(path_prefix=prefix)
+
+    @classmethod
+    def delete_rows(cls, queryset):
+        '''
+        delete the rows of queryset in two queries, without the deletion
+        collector. QuerySet.delete would load every row and query the
+        children of each level for the cascade of parent. It is only
+        skipped for whole subtrees, or the children before their parents,
+        so no row is left pointing to a deleted parent. There are no
+        delete signals on MetaFile.
+
+        The parents are cleared first, so no deleted row refers to another
+        one and the order of the deletion does not matter. Backends which
+        check foreign keys row by row (MySQL) would fail otherwise.
+        '''
+        queryset.update(parent=None)
+        return queryset._raw_delete(queryset.db)
+
+    @classmethod
+    def purge(cls, limit=None, batch_size=1000):
+        '''delete the subtrees removed with SFTPSERVER_DEFERRED_DELETE, returns the number of rows'''
+        count = 0
+        while limit is None or count < limit:
+            size = batch_size if limit is None else min(batch_size, limit - count)
+            # children sort after their parent, they are deleted first or in
+            # the same batch
+            ids = list(cls.objects.filter(root__isnull=True).order_by('-path').values_list(
+                'id', flat=True)[:size])
+            if not ids:
+                break
+            cls.delete_rows(cls.objects.filter(pk__in=ids))
+            count += len(ids)
+        return count
 
     def update_path(self):
+        old_path = self.path
         self.path = os.path.join(self.parent.path, self.filename)
-        self.save()
-        for i in MetaFile.objects.filter(parent=self):
-            i.update_path()
+        with transaction.atomic():
+            self.save()
+            if old_path != self.path:
+                # the prefix of every descendant is replaced in one statement
+                MetaFile.subtree(self.root_id, old_path).update(
+                    path=Concat(Value(self.path), Substr('path', len(old_path) + 1)))
+                paths = [old_path]
+                if self.isdir:
+                    # the moved directories may replace others of the base
+                    # commit with the same path, none of their trees is reused
+                    paths.extend(MetaFile.subtree(self.root_id, self.path).filter(
+                        key__isnull=True).values_list('path', flat=True))
+                Change.record(self.root_id, paths)
 
 
 @python_2_unicode_compatible
 class Data(models.Model):
     key = models.CharField(max_length=40, unique=True)
+    # hash algorithm of key, older rows are sha1
+    algorithm = models.CharField(max_length=16, default='sha1')
     parent_key = models.CharField(max_length=40, blank=True, null=True)
-    size = models.IntegerField(blank=True, null=True)
+    size = models.BigIntegerField(blank=True, null=True)
     data = models.BinaryField(blank=True, null=True)
+    chunked = models.BooleanField(default=False)
+    codec = models.CharField(max_length=8, choices=compression.CODEC_CHOICES, default=compression.NONE)
+    # number of deltas to apply on top of the nearest keyframe
+    depth = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -252,43 +635,386 @@ class Data(models.Model):
 
     @classmethod
     def get(klass, key):
-        value = cache.get(key)
-        if value:
+        blob_cache = get_blob_cache()
+        value = blob_cache.get(key)
+        if value is not None:
             return value
         o = klass.objects.get(key=key)
-        if o.parent_key is None:
-            value = force_bytes(o.data)
+        if o.chunked:
+            # too large to be worth caching as a whole
+            return o.read_range(0, o.size)
+        # walk the chain up to a cached version or a keyframe, then patch down
+        patches = []
+        while o.parent_key is not None:
+            patches.append(o)
+            value = blob_cache.get(o.parent_key)
+            if value is not None:
+                break
+            o = klass.objects.get(key=o.parent_key)
         else:
-            parent_data = klass.get(o.parent_key)
-            value = klass._merge(parent_data, o.data)
-        cache.set(key, force_bytes(value), None)
+            value = compression.decode(o.codec, o.data)
+        for o in reversed(patches):
+            value = klass._merge(value, force_bytes(o.data))
+        # intermediate levels are not cached, they are rarely read again
+        blob_cache.set(key, value)
         return value
 
     @classmethod
-    def put(klass, value, parent_key=None):
-        if not isinstance(value, six.binary_type):
+    def put(klass, value, parent_key=None, codec=None):
+        if isinstance(value, SpooledBlob):
+            # the key is known without reading the payload back
+            key, size, algorithm = value.hexdigest(), value.size, value.algorithm
+        elif isinstance(value, six.binary_type):
+            algorithm = conf.get('HASH_ALGORITHM')
+            key, size = hexdigest(value, algorithm), len(value)
+        else:
             raise TypeError("data type must be binary_type")
-        if len(value) > 100 * 1024 * 1024:
+        if klass.objects.filter(key=key).exists():
+            return key
+        if size > conf.get('CHUNK_THRESHOLD'):
+            klass._put_chunked(key, size, value, codec, algorithm)
+            return key
+        if isinstance(value, SpooledBlob):
+            value = value.getvalue()
+        if size > 100 * 1024 * 1024:
             raise Exception("file size exceed")
-        key = hashlib.sha1(value).hexdigest()
-        cache.set(key, force_bytes(value), None)
-        size = len(value)
-        if not klass.objects.filter(key=key).exists():
-            if parent_key:
-                parent_data = klass.get(key=parent_key)
-                patch = bsdiff4.diff(parent_data, value)
-                if len(value) > 512 and 2 * len(patch) < len(value):
-                    value = patch
-                else:
-                    parent_key = None
-
-            klass.objects.create(key=key, parent_key=parent_key, data=value, size=size)
+        # the next version is likely to be diffed against this one
+        get_blob_cache().set(key, force_bytes(value))
+        if conf.get('ASYNC_DELTA'):
+            # stored in full now, DeltaTask workers compress it later
+            codec, payload = compression.encode(value, codec)
+            try:
+                with transaction.atomic():
+                    klass.objects.create(key=key, algorithm=algorithm, data=payload, codec=codec, size=size)
+                    if parent_key:
+                        DeltaTask.objects.create(key=key, parent_key=parent_key)
+            except IntegrityError:
+                pass
+            return key
+
+        depth = 0
+        parent = klass._delta_parent(parent_key)
+        patch = None if parent is None else klass._diff(klass.get(key=parent_key), value)
+        if patch is not None:
+            # bsdiff patches are already compressed
+            codec, value = compression.NONE, patch
+            depth = parent.depth + 1
+        else:
+            codec, value = compression.encode(value, codec)
+            parent_key = None
+
+        try:
+            with transaction.atomic():
+                klass.objects.create(key=key, algorithm=algorithm, parent_key=parent_key, data=value, codec=codec,
+                                     size=size, depth=depth)
+        except IntegrityError:
+            # stored concurrently by another session, the content is the same
+            pass
         return key
 
+    @classmethod
+    def _delta_parent(klass, parent_key):
+        if not parent_key:
+            return None
+        parent = klass.objects.filter(key=parent_key, chunked=False).only('depth').first()
+        # past MAX_DELTA_DEPTH a full keyframe is stored to bound the cost of get
+        if parent is None or parent.depth >= conf.get('MAX_DELTA_DEPTH'):
+            return None
+        return parent
+
+    @classmethod
+    def _diff(klass, parent_data, value):
+        '''the patch from parent_data to value, None when it is not worth it'''
+        patch = bsdiff4.diff(parent_data, value)
+        if len(value) > 512 and 2 * len(patch) < len(value):
+            return patch
+        return None
+
+    @classmethod
+    def _put_chunked(klass, key, size, value, codec=None, algorithm=None):
+        chunk_size = conf.get('CHUNK_SIZE')
+        if conf.get('CHUNKING') == 'content':
+            stream = value.iter_chunks(chunk_size) if isinstance(value, SpooledBlob) else [value]
+            chunks = Chunker(chunk_size).split(stream)
+        elif isinstance(value, SpooledBlob):
+            chunks = value.iter_chunks(chunk_size)
+        else:
+            chunks = (value[i:i + chunk_size] for i in range(0, len(value), chunk_size))
+
+        manifest = []
+        offset = 0
+        batch = []
+        for chunk in chunks:
+            chunk_key = hexdigest(chunk, algorithm)
+            batch.append(Chunk(key=chunk_key, algorithm=algorithm, size=len(chunk), data=chunk))
+            if len(batch) >= CHUNK_BATCH_SIZE:
+                Chunk.store(batch, codec)
+                batch = []
+            manifest.append(DataChunk(index=len(manifest), offset=offset, size=len(chunk), chunk_key=chunk_key))
+            offset += len(chunk)
+        Chunk.store(batch, codec)
+
+        try:
+            with transaction.atomic():
+                o = klass.objects.create(key=key, algorithm=algorithm, size=size, chunked=True)
+                for item in manifest:
+                    item.data = o
+                DataChunk.objects.bulk_create(manifest, batch_size=CHUNK_BATCH_SIZE)
+        except IntegrityError:
+            # stored concurrently by another session, the content is the same
+            pass
+
+    def rebase(self):
+        '''store this delta as a keyframe, its descendants get shallower'''
+        if self.parent_key is None:
+            return
+        codec, value = compression.encode(Data.get(self.key))
+        with transaction.atomic():
+            Data.objects.filter(pk=self.pk).update(parent_key=None, data=value, codec=codec, depth=0)
+            self._shift_descendants(-self.depth)
+        self.parent_key, self.data, self.codec, self.depth = None, value, codec, 0
+
+    def compress(self, parent_key):
+        '''store this keyframe as a delta of parent_key if that is smaller'''
+        if Data._delta_parent(parent_key) is None or self.chunked or self.parent_key is not None:
+            return False
+        patch = Data._diff(Data.get(parent_key), Data.get(self.key))
+        if patch is None:
+            return False
+        with transaction.atomic():
+            if not Data.objects.filter(pk=self.pk, parent_key__isnull=True).update(
+                    parent_key=parent_key, data=patch, codec=compression.NONE):
+                return False
+            # the parent may be compressed concurrently, its depth is read
+            # under lock, always taken after the one of the child
+            parent = Data.objects.select_for_update().only('depth').get(key=parent_key)
+            if parent.depth >= conf.get('MAX_DELTA_DEPTH'):
+                transaction.set_rollback(True)
+                return False
+            Data.objects.filter(pk=self.pk).update(depth=parent.depth + 1)
+            # versions compressed against this one first get deeper
+            self._shift_descendants(parent.depth + 1)
+        self.parent_key, self.data, self.codec, self.depth = parent_key, patch, compression.NONE, parent.depth + 1
+        return True
+
+    def _shift_descendants(self, delta):
+        keys = [self.key]
+        while keys:
+            qs = Data.objects.filter(parent_key__in=keys)
+            keys = list(qs.values_list('key', flat=True))
+            qs.update(depth=F('depth') + delta)
+
+    @classmethod
+    def rebase_chains(klass, max_depth=None, limit=None):
+        '''rebase the versions deeper than max_depth, returns the number of keyframes stored'''
+        if max_depth is None:
+            max_depth = conf.get('MAX_DELTA_DEPTH')
+        count = 0
+        while limit is None or count < limit:
+            # the shallowest first, rebasing it also shortens the chains below it
+            o = klass.objects.filter(depth__gt=max_depth).order_by('depth', 'id').first()
+            if o is None:
+                break
+            o.rebase()
+            count += 1
+        return count
+
     @classmethod
     def _merge(klass, parent_data, current_data):
         return bsdiff4.patch(parent_data, current_data)
 
+    @classmethod
+    def open(klass, key):
+        return DataReader(key)
+
+    @classmethod
+    def read(klass, key, offset, length):
+        value = get_blob_cache().get(key)
+        if value is not None:
+            return value[offset:offset + length]
+        o = klass.objects.only('id', 'parent_key', 'size', 'chunked', 'codec').get(key=key)
+        return o.read_range(offset, length)
+
+    def read_range(self, offset, length):
+        if self.parent_key is not None or self.codec != compression.NONE:
+            # deltas and compressed rows can only be decoded as a whole
+            return Data.get(self.key)[offset:offset + length]
+        length = min(length, self.size - offset)
+        if length <= 0:
+            return b''
+        if self.chunked:
+            return self._read_chunks(offset, length)
+        qs = Data.objects.filter(pk=self.pk).annotate(part=Substr('data', offset + 1, length))
+        return force_bytes(qs.values_list('part', flat=True)[0] or b'')
+
+    def _read_chunks(self, offset, length):
+        end = offset + length
+        items = list(DataChunk.objects.filter(
+            data=self, offset__lt=end, offset__gt=offset - F('size')).order_by('index'))
+        chunks = {key: compression.decode(codec, data) for key, codec, data in Chunk.objects.filter(
+            key__in=set(x.chunk_key for x in items)).values_list('key', 'codec', 'data')}
+        value = b''.join(chunks[x.chunk_key] for x in items)
+        start = offset - items[0].offset
+        return value[start:start + length]
+
+
+@python_2_unicode_compatible
+class Chunk(models.Model):
+    key = models.CharField(max_length=40, unique=True)
+    algorithm = models.CharField(max_length=16, default='sha1')
+    size = models.IntegerField()
+    data = models.BinaryField()
+    codec = models.CharField(max_length=8, choices=compression.CODEC_CHOICES, default=compression.NONE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return 'Chunk({})'.format(self.key)
+
+    @classmethod
+    def store(klass, chunks, codec=None):
+        '''insert the chunks that are not stored yet'''
+        chunks = list({x.key: x for x in chunks}.values())
+        if not chunks:
+            return
+        existing = set(klass.objects.filter(key__in=[x.key for x in chunks]).values_list('key', flat=True))
+        chunks = [x for x in chunks if x.key not in existing]
+        # only compressed once known to be new
+        for chunk in chunks:
+            chunk.codec, chunk.data = compression.encode(chunk.data, codec)
+        try:
+            with transaction.atomic():
+                klass.objects.bulk_create(chunks)
+        except IntegrityError:
+            # some of them were stored concurrently
+            for chunk in chunks:
+                try:
+                    with transaction.atomic():
+                        chunk.save()
+                except IntegrityError:
+                    pass
+
+
+@python_2_unicode_compatible
+class DataChunk(models.Model):
+    '''ordered manifest entry of a chunked Data'''
+    data = models.ForeignKey(Data, on_delete=models.CASCADE, related_name='chunks')
+    index = models.IntegerField()
+    offset = models.BigIntegerField()
+    size = models.IntegerField()
+    chunk_key = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = (('data', 'index'), )
+        index_together = (('data', 'offset'), )
+
+    def __str__(self):
+        return 'DataChunk({}, {})'.format(self.data_id, self.index)
+
+
+@python_2_unicode_compatible
+class DeltaTask(models.Model):
+    '''a full version waiting to be stored as a delta of parent_key'''
+    key = models.CharField(max_length=40, unique=True)
+    parent_key = models.CharField(max_length=40)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return 'DeltaTask({})'.format(self.key)
+
+    @classmethod
+    def claim(klass, stale=600):
+        '''take the oldest task not being processed, None when the queue is empty'''
+        while True:
+            now = timezone.now()
+            qs = klass.objects.filter(
+                models.Q(started_at__isnull=True) | models.Q(started_at__lt=now - timedelta(seconds=stale)))
+            task = qs.order_by('id').first()
+            if task is None:
+                return None
+            # only one worker wins the update
+            if klass.objects.filter(pk=task.pk, started_at=task.started_at).update(started_at=now):
+                task.started_at = now
+                return task
+
+    def run(self):
+        o = Data.objects.filter(key=self.key).first()
+        compressed = o is not None and o.compress(self.parent_key)
+        self.delete()
+        return compressed
+
+
+class DataReader(object):
+    '''
+    Read-only file object over a stored version, used as ``readfile`` of SFTP
+    handles. Nothing is fetched before the first read, and full (non delta)
+    rows are fetched in READ_WINDOW sized ranges.
+    '''
+
+    def __init__(self, key, window=None):
+        self.key = key
+        self.window = window or conf.get('READ_WINDOW')
+        self._data = None
+        self._cached = None
+        self._buffer_offset = 0
+        self._buffer = b''
+        self._pos = 0
+
+    @property
+    def size(self):
+        return self._row.size
+
+    @property
+    def _row(self):
+        if self._data is None:
+            self._data = Data.objects.only('id', 'parent_key', 'size', 'chunked', 'codec').get(key=self.key)
+        return self._data
+
+    def pread(self, offset, length):
+        if self._cached is None:
+            self._cached = get_blob_cache().get(self.key) or False
+        if self._cached:
+            return self._cached[offset:offset + length]
+        if not (self._buffer_offset <= offset and offset + length <= self._buffer_offset + len(self._buffer)):
+            self._buffer_offset = offset
+            self._buffer = self._row.read_range(offset, max(length, self.window))
+        start = offset - self._buffer_offset
+        return self._buffer[start:start + length]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, length=-1):
+        if length is None or length < 0:
+            length = max(0, self.size - self._pos)
+        data = self.pread(self._pos, length)
+        self._pos += len(data)
+        return data
+
+    def iter_chunks(self, chunk_size=None):
+        offset = 0
+        while True:
+            data = self.pread(offset, chunk_size or self.window)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+
+    def getvalue(self):
+        return self.pread(0, self.size)
+
+    def close(self):
+        self._buffer = b''
+        self._cached = None
+
 
 @python_2_unicode_compatible
 class Commit(models.Model):
@@ -300,6 +1026,10 @@ class Commit(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     root = models.ForeignKey(Root, on_delete=models.PROTECT)
     key = models.CharField(max_length=40, blank=True, null=True)
+    # older commits only have CommitItem rows until get_tree_key is called
+    tree_key = models.CharField(max_length=40, blank=True, null=True)
+    # Root.change_seq when the commit was made
+    change_seq = models.BigIntegerField(blank=True, null=True)
 
     parent_commit = models.ForeignKey("self", blank=True, null=True,
                                       on_delete=models.PROTECT, related_name='children')
@@ -309,12 +1039,259 @@ class Commit(models.Model):
     def __str__(self):
         return 'Commit({})'.format(self.name)
 
+    def get_tree_key(self):
+        if self.tree_key is None:
+            tree_key, trees = Tree.build(CommitItem.objects.filter(commit=self).values_list(
+                'path', 'key', 'size', 'mtime', 'mode').iterator())
+            with transaction.atomic():
+                Tree.store(trees)
+                Commit.objects.filter(pk=self.pk).update(tree_key=tree_key)
+            self.tree_key = tree_key
+        return self.tree_key
+
+    def diff(self, other=None):
+        '''yield a DiffRecord for every path which differs in other, or in the current files of the root'''
+        if other is None:
+            return self.root.diff(self)
+        return Tree.records(self.get_tree_key(), other.get_tree_key())
+
+    def get(self, path):
+        '''TreeEntry of path (with a path attribute), O(depth) queries'''
+        if path != '/' and path.endswith('/'):
+            path = path[:-1]
+        entry = TreeEntry(name='', tree_key=self.get_tree_key(), mode=DIR_MODE)
+        for name in path.split('/'):
+            if name:
+                if entry.tree_key is None:
+                    raise TreeEntry.DoesNotExist(path)
+                entry = TreeEntry.objects.get(tree__key=entry.tree_key, name=name)
+        entry.path = path
+        return entry
+
+    def items(self):
+        '''yield the TreeEntry of every path below '/' (with a path attribute), one query per level'''
+        level = {'/': self.get_tree_key()}
+        while level:
+            paths = {}
+            for k, v in level.items():
+                paths.setdefault(v, []).append(k)
+            level = {}
+            keys = list(paths)
+            for i in range(0, len(keys), TREE_BATCH_SIZE):
+                for entry in TreeEntry.objects.filter(
+                        tree__key__in=keys[i:i + TREE_BATCH_SIZE]).select_related('tree'):
+                    # a subtree may be shared by several paths
+                    for parent in paths[entry.tree.key]:
+                        item = copy.copy(entry)
+                        item.path = os.path.join(parent, entry.name)
+                        if item.isdir:
+                            level[item.path] = item.tree_key
+                        yield item
+
+
+@python_2_unicode_compatible
+class Change(models.Model):
+    '''
+    Journal of the changed paths of a root. A change bumps Root.change_seq
+    and records the changed paths with the new value, which tells if a root
+    changed since a commit and which paths did without reading the files.
+    Nothing is recorded before the first commit, which reads all the files
+    and prunes the journal anyway.
+    '''
+    root = models.ForeignKey(Root, on_delete=models.CASCADE)
+    seq = models.BigIntegerField()
+    path = models.CharField(max_length=4096)
+
+    class Meta:
+        index_together = (('root', 'seq', ))
+
+    def __str__(self):
+        return 'Change({})'.format(self.path)
+
+    @classmethod
+    def record(klass, root_id, paths):
+        if not paths:
+            return
+        with transaction.atomic(savepoint=False):
+            # the root row stays locked until the end of the transaction, a
+            # commit waits for the change or the change for the commit
+            Root.objects.filter(pk=root_id).update(change_seq=F('change_seq') + 1)
+            base_commit_id, seq = Root.objects.filter(pk=root_id).values_list('base_commit', 'change_seq').get()
+            if base_commit_id is None:
+                return
+            klass.objects.bulk_create([klass(root_id=root_id, seq=seq, path=x) for x in paths])
+
+
+@python_2_unicode_compatible
+class Tree(models.Model):
+    '''
+    Content addressed listing of a directory, the key is the hash of its
+    entries and the entries of a subdirectory point to its tree. A commit
+    only refers to its root tree, the trees of the directories it did not
+    change are shared with the other commits.
+    '''
+    key = models.CharField(max_length=40, unique=True)
+    algorithm = models.CharField(max_length=16, default='sha1')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return 'Tree({})'.format(self.key)
+
+    @staticmethod
+    def hash(entries, algorithm=None):
+        h = new_hash(algorithm)
+        for entry in sorted(entries, key=lambda x: x.name):
+            h.update('{} {:o} {}\0{}\0{}\0{:.6f}\n'.format(
+                'tree' if entry.isdir else 'blob', entry.mode, entry.name,
+                entry.tree_key if entry.isdir else entry.key, entry.size, _timestamp(entry.mtime)).encode('UTF-8'))
+        return h.hexdigest()
+
+    @classmethod
+    def build(klass, rows):
+        '''
+        (key of the root tree, {key: entries}) of an iterable of
+        (path, key, size, mtime, mode), nothing is stored
+        '''
+        children = {'/': []}
+        for path, key, size, mtime, mode in rows:
+            if path == '/':
+                continue
+            if key is None:
+                children.setdefault(path, [])
+                size = 0
+            entry = TreeEntry(name=os.path.basename(path), key=key, size=size, mtime=mtime,
+                              mode=mode or (DIR_MODE if key is None else FILE_MODE))
+            children.setdefault(os.path.dirname(path), []).append((path, entry))
+        tree_keys = {}
+        trees = {}
+        # the subdirectories are hashed before their parent
+        for path in sorted(children, key=lambda x: x.count('/') if x != '/' else 0, reverse=True):
+            entries = []
+            for child_path, entry in children[path]:
+                if entry.isdir:
+                    entry.tree_key = tree_keys[child_path]
+                entries.append(entry)
+            tree_keys[path] = klass.hash(entries)
+            trees[tree_keys[path]] = entries
+        return tree_keys['/'], trees
+
+    @classmethod
+    def load(klass, keys, trees):
+        '''read the entries of the keys missing from trees into it'''
+        keys = [x for x in set(keys) if x not in trees]
+        for i in range(0, len(keys), TREE_BATCH_SIZE):
+            for entry in TreeEntry.objects.filter(
+                    tree__key__in=keys[i:i + TREE_BATCH_SIZE]).select_related('tree'):
+                trees.setdefault(entry.tree.key, []).append(entry)
+        for key in keys:
+            trees.setdefault(key, [])
+
+    @classmethod
+    def diff(klass, old_key, new_key, trees=None, expand_added=False, expand_removed=False):
+        '''
+        yield (path, old entry, new entry) of the paths which differ between
+        two trees, the old or the new entry is None for an added or a removed
+        path. Equal subtrees are not read, the content of an added or removed
+        directory is only listed with expand_added or expand_removed. trees
+        holds the entries of the trees which are not stored, the others are
+        read with one query per level.
+        '''
+        trees = dict(trees or {})
+        level = [('/', old_key, new_key)]
+        while level:
+            klass.load([x for _, old, new in level for x in (old, new) if x], trees)
+            next_level = []
+            for path, old_tree, new_tree in level:
+                old = {x.name: x for x in trees[old_tree]} if old_tree else {}
+                new = {x.name: x for x in trees[new_tree]} if new_tree else {}
+                for name in sorted(set(old) | set(new)):
+                    child_path = os.path.join(path, name)
+                    a = old.get(name)
+                    b = new.get(name)
+                    if a is not None and b is not None and a.isdir == b.isdir:
+                        if a.state != b.state:
+                            yield child_path, a, b
+                        if a.isdir and a.tree_key != b.tree_key:
+                            next_level.append((child_path, a.tree_key, b.tree_key))
+                        continue
+                    if a is not None:
+                        yield child_path, a, None
+                        if a.isdir and expand_removed:
+                            next_level.append((child_path, a.tree_key, None))
+                    if b is not None:
+                        yield child_path, None, b
+                        if b.isdir and expand_added:
+                            next_level.append((child_path, None, b.tree_key))
+            level = next_level
+
+    @classmethod
+    def records(klass, old_key, new_key, trees=None):
+        '''
+        yield a DiffRecord for every differing path, including the content of
+        added or removed directories, a level of the tree at a time
+        '''
+        for path, old, new in klass.diff(old_key, new_key, trees, expand_added=True, expand_removed=True):
+            status = ADDED if old is None else REMOVED if new is None else MODIFIED
+            yield DiffRecord(status, path, old, new)
+
+    @classmethod
+    def store(klass, trees):
+        '''insert the trees of {key: entries} that are not stored yet'''
+        keys = list(trees)
+        existing = set()
+        for i in range(0, len(keys), TREE_BATCH_SIZE):
+            existing.update(klass.objects.filter(
+                key__in=keys[i:i + TREE_BATCH_SIZE]).values_list('key', flat=True))
+        keys = [x for x in keys if x not in existing]
+        if not keys:
+            return
+        algorithm = conf.get('HASH_ALGORITHM')
+        # a tree stored concurrently has the same entries
+        klass.objects.bulk_create([klass(key=x, algorithm=algorithm) for x in keys],
+                                  batch_size=TREE_BATCH_SIZE, ignore_conflicts=True)
+        ids = {}
+        for i in range(0, len(keys), TREE_BATCH_SIZE):
+            ids.update(klass.objects.filter(key__in=keys[i:i + TREE_BATCH_SIZE]).values_list('key', 'id'))
+        entries = []
+        for key in keys:
+            for entry in trees[key]:
+                entry.tree_id = ids[key]
+                entries.append(entry)
+        TreeEntry.objects.bulk_create(entries, batch_size=TREE_BATCH_SIZE, ignore_conflicts=True)
+
+
+@python_2_unicode_compatible
+class TreeEntry(MetaFileMixin, models.Model):
+    tree = models.ForeignKey(Tree, on_delete=models.CASCADE, related_name='entries')
+    name = models.CharField(max_length=1024)
+    # Data key of a file, None for a directory
+    key = models.CharField(max_length=40, blank=True, null=True)
+    # Tree key of a directory
+    tree_key = models.CharField(max_length=40, blank=True, null=True)
+    size = models.BigIntegerField(default=0)
+    mtime = models.DateTimeField(blank=True, null=True)
+    mode = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('tree', 'name', ))
+
+    def __str__(self):
+        return 'TreeEntry({})'.format(self.name)
+
+    @property
+    def state(self):
+        '''what the tree hash covers besides the name and the content of a directory'''
+        return (self.key, self.size, self.mode, '{:.6f}'.format(_timestamp(self.mtime)))
+
 
 @python_2_unicode_compatible
 class CommitItem(MetaFileMixin, models.Model):
     commit = models.ForeignKey(Commit, on_delete=models.CASCADE)
     path = models.CharField(max_length=1024)
     key = models.CharField(max_length=40, blank=True, null=True)
+    size = models.BigIntegerField(default=0)
+    mtime = models.DateTimeField(blank=True, null=True)
+    mode = models.IntegerField(default=0)
 
     class Meta:
         unique_together = (('commit', 'path', ))
@@ -324,7 +1301,7 @@ class CommitItem(MetaFileMixin, models.Model):
 
 
 @python_2_unicode_compatible
-class StorageAccessInfo(models.Model):
+class StorageAccessInfo(PermissionMixin, models.Model):
     '''
 storages.backends.s3boto.S3BotoStorage
 
@@ -354,5 +1331,33 @@ url_protocol: https
         kwargs = yaml.load(self.kwargs) if self.kwargs else {}
         return Storage(*args, **kwargs)
 
-    def has_permission(self, user):
-        return bool(user in self.users.all())
+
+# bumped whenever a Root or its members change, sessions drop their cached
+# roots and permissions when it moves
+_root_generation = 0
+
+
+def root_generation():
+    return _root_generation
+
+
+@receiver(post_save, sender=Root)
+@receiver(post_delete, sender=Root)
+@receiver(m2m_changed, sender=Root.users.through)
+@receiver(m2m_changed, sender=Root.groups.through)
+@receiver(post_delete, sender=Group)
+def _invalidate_roots(**kwargs):
+    global _root_generation
+    _root_generation += 1
+
+
+@receiver(m2m_changed, sender=Root.users.through)
+@receiver(m2m_changed, sender=Root.groups.through)
+@receiver(m2m_changed, sender=StorageAccessInfo.users.through)
+@receiver(m2m_changed, sender=StorageAccessInfo.groups.through)
+@receiver(post_delete, sender=Group)
+def _invalidate_permissions(action=None, **kwargs):
+    if action is not None and not action.startswith('post_'):
+        return
+    # every cached permission set becomes unreachable
+    cache.set(PERMISSION_VERSION_KEY, _new_permission_version(), None)
@@ -0,0 +1,199 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import time
+import logging
+import threading
+
+import paramiko
+from six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+HOST_KEY_CLASSES = tuple(getattr(paramiko, x) for x in ('Ed25519Key', 'ECDSAKey', 'RSAKey', 'DSSKey')
+                         if hasattr(paramiko, x))
+
+
+def load_host_key(filename, password=None):
+    '''load a private key of any type supported by paramiko'''
+    for klass in HOST_KEY_CLASSES:
+        try:
+            return klass.from_private_key_file(filename, password=password)
+        except paramiko.PasswordRequiredException:
+            raise
+        except (paramiko.SSHException, ValueError):
+            continue
+    raise paramiko.SSHException('unsupported host key: {}'.format(filename))
+
+
+class Session(object):
+    def __init__(self, transport, channel, server):
+        self.transport = transport
+        self.channel = channel
+        self.server = server
+        self.started_at = time.time()
+
+    @property
+    def last_activity(self):
+        return getattr(self.server, 'last_activity', None) or self.started_at
+
+
+class SessionRegistry(object):
+    '''
+    Keeps track of established sessions.
+
+    A reaper thread drops finished transports and closes sessions that were
+    idle longer than idle_timeout or alive longer than max_lifetime (0
+    disables either limit).
+    '''
+
+    def __init__(self, idle_timeout=0, max_lifetime=0, reap_interval=5):
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.reap_interval = reap_interval
+        self._sessions = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._reaper = None
+
+    def __len__(self):
+        return len(self.reap())
+
+    def __iter__(self):
+        with self._lock:
+            return iter(self._sessions[:])
+
+    def add(self, transport, channel, server):
+        session = Session(transport, channel, server)
+        with self._lock:
+            self._sessions.append(session)
+        return session
+
+    def reap(self):
+        now = time.time()
+        expired = []
+        with self._lock:
+            alive = []
+            for session in self._sessions:
+                if not session.transport.is_active():
+                    continue
+                if self.max_lifetime and now - session.started_at > self.max_lifetime:
+                    expired.append((session, 'max lifetime'))
+                elif self.idle_timeout and now - session.last_activity > self.idle_timeout:
+                    expired.append((session, 'idle timeout'))
+                else:
+                    alive.append(session)
+            self._sessions = alive
+        for session, reason in expired:
+            logger.info('closing session of {}: {}'.format(getattr(session.server, 'client_addr', None), reason))
+            session.transport.close()
+        return alive
+
+    def start(self):
+        def run():
+            while not self._stopped.wait(self.reap_interval):
+                try:
+                    self.reap()
+                except Exception:
+                    logger.exception('reaper error')
+        self._reaper = threading.Thread(target=run, name='sftp-session-reaper')
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def drain(self, timeout, poll_interval=1):
+        '''wait up to timeout seconds for the sessions to end, then close the rest'''
+        deadline = time.time() + timeout
+        while self.reap() and time.time() < deadline:
+            time.sleep(poll_interval)
+        remaining = self.reap()
+        for session in remaining:
+            logger.warning('drain deadline exceeded, closing session of {}'.format(
+                getattr(session.server, 'client_addr', None)))
+            session.transport.close()
+        return len(remaining)
+
+
+class HandshakePool(object):
+    '''
+    Runs key exchange and channel accept of incoming connections on a bounded
+    set of worker threads, so the accept loop never waits on a single client.
+
+    transport_factory(conn, addr) must return a (transport, server) pair that
+    is ready for ``transport.start_server``. Established sessions are added
+    to ``sessions``.
+    '''
+
+    def __init__(self, transport_factory, max_handshakes=16, max_sessions=0, accept_timeout=30,
+                 sessions=None):
+        self.transport_factory = transport_factory
+        self.max_handshakes = max_handshakes
+        self.max_sessions = max_sessions
+        self.accept_timeout = accept_timeout
+        self.sessions = SessionRegistry() if sessions is None else sessions
+        self._queue = queue.Queue(maxsize=max_handshakes)
+        self._workers = []
+        for i in range(max_handshakes):
+            worker = threading.Thread(target=self._run, name='sftp-handshake-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, conn, addr):
+        if self.max_sessions and len(self.sessions) >= self.max_sessions:
+            logger.warning('max sessions ({}) reached, rejecting {}'.format(self.max_sessions, addr))
+            conn.close()
+            return False
+        # blocks while every worker is busy and the backlog is full
+        self._queue.put((conn, addr))
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            conn, addr = item
+            try:
+                self._handshake(conn, addr)
+            except Exception:
+                logger.exception('handshake error')
+
+    def _handshake(self, conn, addr):
+        transport, server = self.transport_factory(conn, addr)
+        try:
+            transport.start_server(server=server)
+            channel = transport.accept(timeout=self.accept_timeout)
+        except Exception:
+            transport.close()
+            raise
+        if channel is None:
+            logger.info('no channel opened by {} within {}s'.format(addr, self.accept_timeout))
+            transport.close()
+            return
+        self.sessions.add(transport, channel, server)
+
+    def shutdown(self, wait=False, timeout=None, drop_pending=False):
+        '''
+        stop the workers once the queued handshakes are done, or close the
+        queued connections first with drop_pending
+        '''
+        if drop_pending:
+            try:
+                while True:
+                    item = self._queue.get_nowait()
+                    if item is not None:
+                        item[0].close()
+            except queue.Empty:
+                pass
+        # queued after the pending connections, the workers handle those first
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            deadline = None if timeout is None else time.time() + timeout
+            for worker in self._workers:
+                worker.join(None if deadline is None else max(0, deadline - time.time()))
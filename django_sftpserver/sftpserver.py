@@ -3,14 +3,15 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 from __future__ import print_function
 
-import io
 import os
 import logging
 import paramiko
+import time as _time
 import stat as _stat
 
 from django.contrib.auth import get_user_model
-from . import models
+from . import conf, models
+from .blob import SpooledBlob
 
 logger = logging.getLogger(__name__)
 
@@ -29,8 +30,12 @@ class StubServer(paramiko.ServerInterface):
 
     def __init__(self, addr=None, *args, **kwargs):
         self.client_addr = addr
+        self.last_activity = _time.time()
         super(StubServer, self).__init__(*args, **kwargs)
 
+    def touch(self):
+        self.last_activity = _time.time()
+
     def _set_username(self, username):
         root, branch = None, None
         if '/' in username:
@@ -86,39 +91,52 @@ class StubSFTPHandle(paramiko.SFTPHandle):
     @_log_error
     def __init__(self, server, root, path, flags):
         super(StubSFTPHandle, self).__init__(flags)
+        self._server = server
         self._fileobj = root.get(path)
-        self._bytesio = io.BytesIO(self._fileobj.data)
+        self._flags = flags
+        self._modified = False
         # 'ab', 'wb', 'a+b', 'r+b', 'rb'
-        self._read_only = False
-        if flags & os.O_WRONLY:
-            if flags & os.O_APPEND:
-                self._bytesio.seek(self._fileobj.size)
-            else:
-                self._bytesio.seek(0)
-        elif flags & os.O_RDWR:
-            if flags & os.O_APPEND:
-                self._bytesio.seek(self._fileobj.size)
+        self._read_only = not (flags & (os.O_WRONLY | os.O_RDWR))
+        if self._read_only:
+            # content is fetched lazily, by range, on the first read
+            self.readfile = models.Data.open(self._fileobj.key)
+        else:
+            # writes go to a spooled blob which hashes them as they arrive
+            self._blob = SpooledBlob()
+            if flags & os.O_TRUNC:
+                self._modified = self._fileobj.size > 0
             else:
-                self._bytesio.seek(0)
-        else:  # O_RDONLY (== 0)
-            self._read_only = True
-            self._bytesio.seek(0)
-        # self.filename = path
-        self._modified = False
-        self.readfile = self._bytesio
-        self.writefile = self._bytesio
+                offset = 0
+                for data in models.Data.open(self._fileobj.key).iter_chunks():
+                    self._blob.write(offset, data)
+                    offset += len(data)
 
     @_log_error
     def close(self):
         if (not self._read_only) and self._modified:
-            self._fileobj.data = self._bytesio.getvalue()
+            self._fileobj.data = self._blob
             self._fileobj.save()
+        if not self._read_only:
+            self._blob.close()
         super(StubSFTPHandle, self).close()
 
+    @_log_error
+    def read(self, offset, length):
+        self._server.touch()
+        if self._read_only:
+            return super(StubSFTPHandle, self).read(offset, length)
+        return self._blob.read(offset, length)
+
     @_log_error
     def write(self, offset, data):
+        self._server.touch()
+        if self._read_only:
+            return paramiko.SFTP_PERMISSION_DENIED
+        if self._flags & os.O_APPEND:
+            offset = self._blob.size
+        self._blob.write(offset, data)
         self._modified = True
-        return super(StubSFTPHandle, self).write(offset, data)
+        return paramiko.SFTP_OK
 
     @_log_error
     def stat(self):
@@ -137,6 +155,9 @@ class StubSFTPServer(paramiko.SFTPServerInterface):
         self.server = server
         self.user = self.server.user
         self.root = self.server.root
+        # name -> (root, permitted, resolved at)
+        self._roots = {}
+        self._roots_generation = models.root_generation()
         logger.debug("initialized")
 
     @_log_error
@@ -148,7 +169,12 @@ class StubSFTPServer(paramiko.SFTPServerInterface):
         logger.debug("session ended")
         self.server = None
 
+    def touch(self):
+        if self.server:
+            self.server.touch()
+
     def _resolve(self, path):
+        self.touch()
         path = self.canonicalize(path)
         if self.root:
             return self.root, path
@@ -157,11 +183,25 @@ class StubSFTPServer(paramiko.SFTPServerInterface):
             if not l[1]:
                 return None, '/'
             else:
-                r = models.Root.objects.get(name=l[1])
-                if not r.has_permission(self.user):
+                r, permitted = self._get_root(l[1])
+                if not permitted:
                     raise Exception()
                 return r, '/' + os.path.sep.join(l[2:])
 
+    def _get_root(self, name):
+        '''Root and permission of the user, cached for the session'''
+        generation = models.root_generation()
+        if generation != self._roots_generation:
+            self._roots = {}
+            self._roots_generation = generation
+        now = _time.time()
+        entry = self._roots.get(name)
+        # changes made by other processes are seen after ROOT_CACHE_TIMEOUT
+        if entry is None or now - entry[2] > conf.get('ROOT_CACHE_TIMEOUT'):
+            r = models.Root.objects.get(name=name)
+            entry = self._roots[name] = (r, r.has_permission(self.user), now)
+        return entry[:2]
+
     def _directory_attr(self, filename):
         attr = paramiko.SFTPAttributes()
         attr.filename = filename
@@ -179,16 +219,17 @@ class StubSFTPServer(paramiko.SFTPServerInterface):
         root, path = self._resolve(path)
         result = []
         if root is None:
-            for r in models.Root.objects.all():
-                if not r.has_permission(self.user):
-                    continue
-                result.append(self._directory_attr(r.name))
+            for name in models.Root.accessible_by(self.user).values_list('name', flat=True):
+                result.append(self._directory_attr(name))
         else:
-            for fobj in root.ls(path):
-                attr = paramiko.SFTPAttributes.from_stat(fobj.stat)
-                attr.filename = fobj.filename
-                result.append(attr)
-        logger.debug('list folder : {} -> {}'.format(path, result))
+            try:
+                stats = root.listdir(path)
+            except models.MetaFile.DoesNotExist:
+                return paramiko.SFTP_NO_SUCH_FILE
+            from_stat = paramiko.SFTPAttributes.from_stat
+            result = [from_stat(x, x.filename) for x in stats]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('list folder : {} -> {}'.format(path, result))
         return result
 
     @_log_error
@@ -81,8 +81,12 @@ class StubServer(paramiko.ServerInterface):
 
     def __init__(self, addr=None, *args, **kwargs):
         self.client_addr = addr
+        self.last_activity = _time.time()
         super(StubServer, self).__init__(*args, **kwargs)
 
+    def touch(self):
+        self.last_activity = _time.time()
+
     def _set_username(self, username):
         storage_name = None
         if '/' in username:
@@ -95,14 +99,8 @@ class StubServer(paramiko.ServerInterface):
         self.user = get_user_model().objects.get(username=username)
         self.storage_name = storage_name
         if self.storage_name is None:
-            valid_count = 0
             self.storage_access_info = None
-            for sai in models.StorageAccessInfo.objects.all():
-                if sai.has_permission(self.user):
-                    valid_count += 1
-            if valid_count == 0:
-                return False
-            return True
+            return bool(models.StorageAccessInfo.accessible_ids(self.user))
         else:
             self.storage_access_info = models.StorageAccessInfo.objects.get(name=self.storage_name)
         return self.storage_access_info.has_permission(self.user)
@@ -138,6 +136,7 @@ class StubSFTPHandle(paramiko.SFTPHandle):
     @_log_error
     def __init__(self, server, storage, path, flags):
         super(StubSFTPHandle, self).__init__(flags)
+        self._server = server
         self._storage = storage
         self._path = path
         self._flags = flags
@@ -161,6 +160,16 @@ class StubSFTPHandle(paramiko.SFTPHandle):
         self.readfile = fileobj
         self.writefile = fileobj
 
+    @_log_error
+    def read(self, offset, length):
+        self._server.touch()
+        return super(StubSFTPHandle, self).read(offset, length)
+
+    @_log_error
+    def write(self, offset, data):
+        self._server.touch()
+        return super(StubSFTPHandle, self).write(offset, data)
+
     @_log_error
     def stat(self):
         return _file_attr(self._storage, self._path)
@@ -182,9 +191,8 @@ class StubSFTPServer(paramiko.SFTPServerInterface):
             self.storage = server.storage_access_info.get_storage()
         else:
             self.storages = {}
-            for sai in models.StorageAccessInfo.objects.all():
-                if sai.has_permission(self.user):
-                    self.storages[sai.name] = sai.get_storage()
+            for sai in models.StorageAccessInfo.accessible_by(self.user):
+                self.storages[sai.name] = sai.get_storage()
         logger.debug("initialized")
 
     @_log_error
@@ -196,7 +204,12 @@ class StubSFTPServer(paramiko.SFTPServerInterface):
         logger.debug("session ended")
         self.server = None
 
+    def touch(self):
+        if self.server:
+            self.server.touch()
+
     def _resolve(self, path):
+        self.touch()
         path = self.canonicalize(path)
         if self.storage:
             return self.storage, path[1:]
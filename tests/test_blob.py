@@ -0,0 +1,41 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import hashlib
+
+from django.test import SimpleTestCase
+
+from django_sftpserver.blob import SpooledBlob
+
+
+class TestDjango_sftpserver_spooled_blob(SimpleTestCase):
+
+    def test_sequential(self):
+        blob = SpooledBlob(max_memory=16)
+        data = b''
+        for i in range(10):
+            chunk = 'chunk-{}'.format(i).encode('ascii')
+            blob.write(len(data), chunk)
+            data += chunk
+        self.assertEqual(blob.size, len(data))
+        self.assertEqual(blob.hexdigest(), hashlib.sha1(data).hexdigest())
+        self.assertEqual(blob.getvalue(), data)
+        self.assertEqual(blob.read(3, 4), data[3:7])
+        blob.close()
+
+    def test_rewrite(self):
+        blob = SpooledBlob(max_memory=16)
+        blob.write(0, b'hello world')
+        blob.write(0, b'HELLO')
+        self.assertEqual(blob.hexdigest(), hashlib.sha1(b'HELLO world').hexdigest())
+        blob.close()
+
+    def test_out_of_order(self):
+        blob = SpooledBlob()
+        blob.write(5, b' world')
+        blob.write(0, b'hello')
+        self.assertEqual(blob.getvalue(), b'hello world')
+        self.assertEqual(blob.hexdigest(), hashlib.sha1(b'hello world').hexdigest())
+        blob.close()
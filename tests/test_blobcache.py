@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_django-sftpserver
+------------
+
+Tests for `django-sftpserver` blobcache module.
+"""
+from django.core.cache import caches
+from django.test import TestCase
+
+from django_sftpserver import blobcache
+
+
+class TestDjango_sftpserver_blobcache(TestCase):
+
+    def test_lru(self):
+        c = blobcache.BlobCache(max_size=10, max_entry_size=8)
+        c.set('a', b'1234')
+        c.set('b', b'5678')
+        self.assertEqual(c.get('a'), b'1234')
+        c.set('c', b'90')
+        c.set('d', b'12')
+        # 'b' is the least recently used
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('a'), b'1234')
+        self.assertEqual(c.size, 8)
+        self.assertFalse(c.set('e', b'123456789'))
+        self.assertNotIn('e', c)
+        self.assertEqual(c.stats(), {'entries': 3, 'size': 8, 'hits': 2, 'backend_hits': 0,
+                                     'misses': 1, 'skipped': 1})
+
+    def test_backend(self):
+        backend = caches['default']
+        backend.clear()
+        c = blobcache.BlobCache(max_size=10, max_entry_size=8, backend=backend)
+        c.set('a', b'1234')
+        c.clear()
+        self.assertEqual(c.get('a'), b'1234')
+        self.assertEqual(c.backend_hits, 1)
+        self.assertIn('a', c)
+
+    def test_settings(self):
+        with self.settings(SFTPSERVER_BLOB_CACHE_SIZE=100):
+            self.assertEqual(blobcache.get_blob_cache().max_size, 100)
+        self.assertNotEqual(blobcache.get_blob_cache().max_size, 100)
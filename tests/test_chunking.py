@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_django-sftpserver
+------------
+
+Tests for `django-sftpserver` chunking module.
+"""
+import random
+import unittest
+
+from django.test import TestCase
+
+from django_sftpserver import chunking
+
+
+class TestDjango_sftpserver_chunking(TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.data = bytes(bytearray(rng.getrandbits(8) for _ in range(100000)))
+
+    def test_split(self):
+        chunker = chunking.Chunker(1024, use_numpy=False)
+        chunks = list(chunker.split(self.data[i:i + 3000] for i in range(0, len(self.data), 3000)))
+        self.assertEqual(b''.join(chunks), self.data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(chunker.min_size <= len(chunk) <= chunker.max_size)
+        # the boundaries do not depend on how the stream is fed
+        self.assertEqual(list(chunker.split([self.data])), chunks)
+
+    def test_max_size(self):
+        chunker = chunking.Chunker(1024, use_numpy=False)
+        chunks = list(chunker.split([b'\0' * 10000]))
+        self.assertEqual([len(x) for x in chunks], [4096, 4096, 1808])
+
+    @unittest.skipIf(chunking.numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        self.assertEqual(chunking.Chunker(1024).cut_points(self.data),
+                         chunking.Chunker(1024, use_numpy=False).cut_points(self.data))
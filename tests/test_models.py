@@ -8,10 +8,23 @@ test_django-sftpserver
 Tests for `django-sftpserver` models module.
 """
 import stat as _stat
+import random
+import unittest
+import hashlib
 
-from django.test import TestCase
+import six
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.contrib.auth.models import Group
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from django_sftpserver import models
+from django_sftpserver.blob import SpooledBlob
+from django_sftpserver.blobcache import get_blob_cache
 
 
 class TestDjango_sftpserver_files(TestCase):
@@ -60,6 +73,152 @@ class TestDjango_sftpserver_files(TestCase):
         self.root.put('/a', self.sample_data_2)
         self.assertEqual(models.MetaFile.objects.get(root=self.root, path='/a').data, self.sample_data_2)
 
+    def test_put_blob(self):
+        blob = SpooledBlob(max_memory=4)
+        blob.write(0, self.sample_data)
+        fileobj = self.root.put('/a', blob)
+        self.assertEqual(fileobj.key, hashlib.sha1(self.sample_data).hexdigest())
+        self.assertEqual(self.root.get('/a').data, self.sample_data)
+        self.assertEqual(self.root.get('/a').size, len(self.sample_data))
+        self.root.put('/b', blob)
+        self.assertEqual(models.Data.objects.all().count(), 1)
+
+    @unittest.skipIf(not hasattr(hashlib, 'blake2b'), 'blake2b is not available')
+    def test_hash_algorithm(self):
+        old = self.root.put('/a', self.sample_data)
+        with self.settings(SFTPSERVER_HASH_ALGORITHM='blake2b'):
+            fileobj = self.root.put('/b', self.sample_data_2)
+            blob = SpooledBlob()
+            blob.write(0, self.sample_data_2)
+            self.assertEqual(self.root.put('/c', blob).key, fileobj.key)
+        self.assertEqual(fileobj.key, hashlib.blake2b(self.sample_data_2, digest_size=20).hexdigest())
+        self.assertEqual(models.Data.objects.get(key=fileobj.key).algorithm, 'blake2b')
+        self.assertEqual(models.Data.objects.get(key=old.key).algorithm, 'sha1')
+        get_blob_cache().clear()
+        self.assertEqual(self.root.get('/a').data, self.sample_data)
+        self.assertEqual(self.root.get('/c').data, self.sample_data_2)
+
+    def test_read_range(self):
+        data = bytes(bytearray(range(256))) * 16
+        fileobj = self.root.put('/a', data)
+        get_blob_cache().delete(fileobj.key)
+        reader = models.Data.open(fileobj.key)
+        reader.window = 100
+        self.assertEqual(reader.pread(10, 20), data[10:30])
+        self.assertEqual(reader.pread(4000, 200), data[4000:])
+        reader.seek(1000)
+        self.assertEqual(reader.read(50), data[1000:1050])
+        self.assertEqual(reader.getvalue(), data)
+        self.assertEqual(models.Data.read(fileobj.key, 5, 5), data[5:10])
+
+    @override_settings(SFTPSERVER_CHUNKING='fixed', SFTPSERVER_CHUNK_SIZE=1000, SFTPSERVER_CHUNK_THRESHOLD=2000)
+    def test_put_chunked(self):
+        data = bytes(bytearray(range(256))) * 20
+        fileobj = self.root.put('/a', data)
+        o = models.Data.objects.get(key=fileobj.key)
+        self.assertTrue(o.chunked)
+        self.assertEqual(o.chunks.count(), 6)
+        get_blob_cache().delete(fileobj.key)
+        self.assertEqual(models.Data.get(fileobj.key), data)
+        self.assertEqual(models.Data.read(fileobj.key, 990, 1020), data[990:2010])
+        self.assertEqual(models.Data.read(fileobj.key, 5000, 500), data[5000:])
+
+        # only the changed chunk is stored again
+        self.root.put('/b', data[:5000] + b'x' * 120)
+        self.assertEqual(models.Chunk.objects.count(), 7)
+
+    @override_settings(SFTPSERVER_CHUNK_SIZE=1024, SFTPSERVER_CHUNK_THRESHOLD=2000)
+    def test_put_content_chunked(self):
+        rng = random.Random(0)
+        data = bytes(bytearray(rng.getrandbits(8) for _ in range(50000)))
+        self.root.put('/a', data)
+        count = models.Chunk.objects.count()
+        # an insertion near the start only changes the chunk around it
+        fileobj = models.Root.objects.create(name='other').put('/b', data[:100] + b'inserted' + data[100:])
+        self.assertLessEqual(models.Chunk.objects.count(), count + 2)
+        get_blob_cache().delete(fileobj.key)
+        self.assertEqual(models.Data.get(fileobj.key), data[:100] + b'inserted' + data[100:])
+
+    def _put_versions(self, path, n):
+        data = bytes(bytearray(range(256))) * 8
+        for i in range(n):
+            data = data[:i] + b'x' + data[i + 1:]
+            fileobj = self.root.put(path, data)
+        return fileobj, data
+
+    @override_settings(SFTPSERVER_MAX_DELTA_DEPTH=3)
+    def test_delta_depth(self):
+        fileobj, data = self._put_versions('/a', 10)
+        depths = list(models.Data.objects.exclude(size=0).order_by('id').values_list('depth', flat=True))
+        self.assertEqual(depths, [0, 1, 2, 3, 0, 1, 2, 3, 0, 1])
+        blob_cache = get_blob_cache()
+        blob_cache.clear()
+        self.assertEqual(models.Data.get(fileobj.key), data)
+        # only the requested version is cached, not the keyframe it was patched on
+        self.assertEqual(len(blob_cache), 1)
+        self.assertIn(fileobj.key, blob_cache)
+
+    def test_rebase_chains(self):
+        fileobj, data = self._put_versions('/a', 10)
+        self.assertEqual(models.Data.objects.get(key=fileobj.key).depth, 9)
+        self.assertEqual(models.Data.rebase_chains(max_depth=2), 3)
+        self.assertEqual(models.Data.objects.filter(depth__gt=2).count(), 0)
+        self.assertEqual(models.Data.objects.get(key=fileobj.key).depth, 0)
+        get_blob_cache().clear()
+        self.assertEqual(models.Data.get(fileobj.key), data)
+
+    @override_settings(SFTPSERVER_ASYNC_DELTA=True)
+    def test_async_delta(self):
+        fileobj, data = self._put_versions('/a', 3)
+        self.assertEqual(models.Data.objects.filter(parent_key__isnull=False).count(), 0)
+        self.assertEqual(models.DeltaTask.objects.count(), 2)
+        # the newest version is compressed first, its parent is then compressed below it
+        task = models.DeltaTask.objects.order_by('-id')[0]
+        self.assertTrue(task.run())
+        while True:
+            task = models.DeltaTask.claim()
+            if task is None:
+                break
+            self.assertIsNone(models.DeltaTask.claim())
+            task.run()
+        self.assertEqual(models.Data.objects.get(key=fileobj.key).depth, 2)
+        get_blob_cache().clear()
+        self.assertEqual(models.Data.get(fileobj.key), data)
+
+    def test_codec(self):
+        data = b'id,name,value\n' + b''.join('{},name{},{}\n'.format(i, i, i * 7).encode('ascii') for i in range(500))
+        fileobj = self.root.put('/a.csv', data)
+        o = models.Data.objects.get(key=fileobj.key)
+        self.assertEqual(o.codec, 'zlib')
+        self.assertLess(len(o.data), len(data) // 2)
+        get_blob_cache().clear()
+        self.assertEqual(models.Data.read(fileobj.key, 100, 50), data[100:150])
+        self.assertEqual(self.root.get('/a.csv').data, data)
+
+        # incompressible content is stored raw
+        rng = random.Random(0)
+        noise = bytes(bytearray(rng.getrandbits(8) for _ in range(5000)))
+        self.assertEqual(models.Data.objects.get(key=self.root.put('/b', noise).key).codec, 'none')
+
+        root = models.Root.objects.create(name='raw', codec='none')
+        fileobj = root.put('/a.csv', data + b'0')
+        self.assertEqual(models.Data.objects.get(key=fileobj.key).codec, 'none')
+
+    def test_codec_query(self):
+        self.root.put('/a', self.sample_data)
+        fileobj = self.root.get('/a')
+        with self.assertNumQueries(0):
+            self.assertIsNone(fileobj.codec)
+        self.root.codec = 'bz2'
+        self.assertEqual(self.root.get('/a').codec, 'bz2')
+
+    @override_settings(SFTPSERVER_CHUNK_SIZE=1024, SFTPSERVER_CHUNK_THRESHOLD=2000, SFTPSERVER_CODEC='bz2')
+    def test_codec_chunked(self):
+        data = b''.join('line {}\n'.format(i).encode('ascii') for i in range(2000))
+        fileobj = self.root.put('/a', data)
+        self.assertIn('bz2', set(models.Chunk.objects.values_list('codec', flat=True)))
+        self.assertEqual(models.Data.read(fileobj.key, 3000, 2000), data[3000:5000])
+
     def test_put_file_recursive(self):
         self.root.put('/a/b/c', self.sample_data)
         self.assertEqual(models.MetaFile.objects.filter(root=self.root, path='/').count(), 1)
@@ -74,6 +233,28 @@ class TestDjango_sftpserver_files(TestCase):
         self.assertTrue(self.root.get('/a').stat.st_mode & _stat.S_IFREG)
         self.assertTrue(self.root.get('/b/').stat.st_mode & _stat.S_IFDIR)
 
+    def test_listdir(self):
+        for i in range(10):
+            self.root.put('/d/{}'.format(i), self.sample_data)
+        with self.assertNumQueries(1):
+            result = self.root.listdir('/d/')
+        self.assertEqual(sorted(x.filename for x in result), [str(i) for i in range(10)])
+        self.assertEqual(set(x.st_size for x in result), {len(self.sample_data)})
+
+    def test_stat_queries(self):
+        self.root.put('/a', self.sample_data)
+        fileobj = self.root.get('/a')
+        with self.assertNumQueries(0):
+            st = fileobj.stat
+        self.assertEqual(st.st_size, len(self.sample_data))
+        self.assertTrue(st.st_mtime > 0)
+        self.root.put('/a', self.sample_data_2)
+        self.assertEqual(self.root.get('/a').stat.st_size, len(self.sample_data_2))
+        commit = self.root.commit()
+        item = commit.get('/a')
+        self.assertEqual(item.stat.st_size, len(self.sample_data_2))
+        self.assertEqual(item.stat.st_mtime, self.root.get('/a').stat.st_mtime)
+
     def test_remove_file(self):
         self.root.put('/a', self.sample_data)
         self.assertEqual(models.MetaFile.objects.filter(root=self.root, path='/a').count(), 1)
@@ -92,6 +273,54 @@ class TestDjango_sftpserver_files(TestCase):
         self.root.remove('/a/')
         self.assertEqual(models.MetaFile.objects.filter(root=self.root, path='/a/b/c').count(), 0)
 
+    def test_remove_tree(self):
+        for name in ('/a/b/c', '/a/b/d/e', '/a/f', '/A/g', '/a_b/g'):
+            self.root.put(name, self.sample_data)
+        self.root.put('/p/q', self.sample_data)
+        with CaptureQueriesContext(connection) as small:
+            self.root.remove('/p')
+        with self.assertNumQueries(len(small)):
+            self.root.remove('/a/')
+        paths = set(models.MetaFile.objects.values_list('path', flat=True))
+        self.assertEqual(paths, {'/', '/A', '/A/g', '/a_b', '/a_b/g'})
+
+    @override_settings(SFTPSERVER_DEFERRED_DELETE=True)
+    def test_remove_deferred(self):
+        for name in ('/a/b/c', '/a/b/d/e', '/a/f', '/x'):
+            self.root.put(name, self.sample_data)
+        self.root.remove('/a')
+        self.root.remove('/x')
+        self.assertFalse(self.root.exists('/a/b/c'))
+        self.assertEqual([x.filename for x in self.root.listdir('/')], [])
+        self.assertEqual(models.MetaFile.objects.filter(root__isnull=True).count(), 6)
+        # the path can be used again before the purge
+        self.root.put('/a/b/c', self.sample_data)
+        self.assertEqual(models.MetaFile.purge(limit=4, batch_size=3), 4)
+        self.assertEqual(models.MetaFile.purge(batch_size=3), 2)
+        self.assertEqual(models.MetaFile.objects.filter(root__isnull=True).count(), 0)
+        self.assertEqual(self.root.get('/a/b/c').data, self.sample_data)
+
+    def test_remove_no_orphans(self):
+        def orphans():
+            return models.MetaFile.objects.filter(parent__isnull=False).exclude(
+                parent__in=models.MetaFile.objects.values('pk'))
+        for name in ('/a/b/c', '/a/b/d/e', '/a/f', '/x/y', '/z'):
+            self.root.put(name, self.sample_data)
+        c = self.root.commit()
+        self.root.remove('/a/b')
+        self.assertFalse(orphans().exists())
+        self.root.checkout(c)
+        # checkout deletes the subtrees which are not in the commit
+        self.root.put('/n/o/p', self.sample_data)
+        self.root.checkout(c)
+        self.assertFalse(self.root.exists('/n'))
+        self.assertFalse(orphans().exists())
+        with self.settings(SFTPSERVER_DEFERRED_DELETE=True):
+            self.root.remove('/a')
+        models.MetaFile.purge(batch_size=2)
+        self.assertFalse(orphans().exists())
+        self.assertEqual(models.MetaFile.objects.filter(root__isnull=True).count(), 0)
+
     def test_rename_file(self):
         self.root.put('/a', self.sample_data)
         self.assertEqual(models.MetaFile.objects.filter(root=self.root, path='/a').count(), 1)
@@ -115,6 +344,21 @@ class TestDjango_sftpserver_files(TestCase):
         self.assertEqual(models.MetaFile.objects.filter(root=self.root, path='/a/b/c').count(), 0)
         self.assertEqual(models.MetaFile.objects.filter(root=self.root, path='/a/z/c').count(), 1)
 
+    def test_rename_tree(self):
+        for name in ('/a/b/c', '/a/b/d/e', '/a/f', '/a_b/g'):
+            self.root.put(name, self.sample_data)
+        self.root.put('/p/q', self.sample_data)
+        with CaptureQueriesContext(connection) as small:
+            self.root.rename('/p', '/z/y')
+        with self.assertNumQueries(len(small)):
+            self.root.rename('/a', '/x/y')
+        paths = set(models.MetaFile.objects.filter(root=self.root).values_list('path', flat=True))
+        self.assertEqual(paths, {'/', '/z', '/z/y', '/z/y/q', '/x', '/x/y', '/x/y/b', '/x/y/b/c',
+                                 '/x/y/b/d', '/x/y/b/d/e', '/x/y/f', '/a_b', '/a_b/g'})
+        self.assertEqual(self.root.get('/x/y/b/d/e').parent, self.root.get('/x/y/b/d'))
+        self.assertEqual(self.root.get('/x/y/b/d/e').data, self.sample_data)
+        self.assertRaises(Exception, self.root.rename, '/x', '/x/y/z')
+
     def test_mkdir(self):
         self.root.mkdir('/a/b/c/')
         self.assertEqual(models.MetaFile.objects.filter(root=self.root, path='/').count(), 1)
@@ -122,12 +366,297 @@ class TestDjango_sftpserver_files(TestCase):
         self.assertEqual(models.MetaFile.objects.filter(root=self.root, path='/a/b').count(), 1)
         self.assertEqual(models.MetaFile.objects.filter(root=self.root, path='/a/b/c').count(), 1)
 
+    def test_mkdir_bulk(self):
+        self.root.mkdir('/a/')
+        with self.assertNumQueries(8):
+            # lookup, savepoint, insert, fetch, parent update, change_seq bump,
+            # base commit read of Change.record, release
+            d = self.root.mkdir_if_not_exists('/a/b/c/d/e/')
+        self.assertEqual(d.path, '/a/b/c/d/e')
+        self.assertEqual(d.parent.parent.parent.path, '/a/b')
+        self.assertEqual(d.parent.parent.parent.parent, self.root.get('/a'))
+        self.assertTrue(d.isdir and d.stat.st_mode & _stat.S_IFDIR)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.root.mkdir_if_not_exists('/a/b/c/d/e'), d)
+        self.assertEqual([x.filename for x in self.root.listdir('/a/b/c/d')], ['e'])
+
 
 class TestDjango_sftpserver_commit(TestCase):
 
     def setUp(self):
         self.root = models.Root.objects.create(name="test")
         self.root.mkdir('/')
+        self.sample_data = b'sample'
 
     def test_commit(self):
         self.root.commit()
+
+    def test_commit_trees(self):
+        for name in ('/a/b/c', '/a/b/d', '/e/f', '/g'):
+            self.root.put(name, name.encode('UTF-8'))
+        c1 = self.root.commit()
+        self.assertFalse(self.root.dirty)
+        self.assertEqual(models.Tree.objects.count(), 4)
+        self.root.put('/e/f', b'changed')
+        self.assertTrue(self.root.dirty)
+        c2 = self.root.commit()
+        self.assertEqual(c2.parent_commit, c1)
+        # '/' and '/e' are new, '/a' and '/a/b' are shared
+        self.assertEqual(models.Tree.objects.count(), 6)
+        self.assertEqual(c1.get('/a').tree_key, c2.get('/a').tree_key)
+        self.assertEqual(c1.get('/e/f').data, b'/e/f')
+        self.assertEqual(c2.get('/e/f').data, b'changed')
+        self.assertEqual(sorted(x.path for x in c2.items()),
+                         ['/a', '/a/b', '/a/b/c', '/a/b/d', '/e', '/e/f', '/g'])
+        self.assertRaises(models.TreeEntry.DoesNotExist, c2.get, '/g/h')
+        self.root.remove('/g')
+        self.assertTrue(self.root.dirty)
+
+    def test_commit_rename_into_place(self):
+        self.root.put('/in/sub/old', b'old')
+        self.root.put('/staging/sub/new', b'new')
+        self.root.commit()
+        self.root.remove('/in')
+        self.root.rename('/staging', '/in')
+        c = self.root.commit()
+        self.assertEqual(sorted(x.path for x in c.items()), ['/in', '/in/sub', '/in/sub/new'])
+        self.assertEqual(c.get('/in/sub/new').data, b'new')
+        self.assertFalse(self.root.dirty)
+
+    def test_commit_swap(self):
+        self.root.put('/a/sub/x', b'x')
+        self.root.put('/b/sub/y', b'y')
+        self.root.commit()
+        self.root.rename('/a', '/t')
+        self.root.rename('/b', '/a')
+        self.root.rename('/t', '/b')
+        self.assertEqual([x.path for x in self.root.diff() if x.status != models.MODIFIED],
+                         ['/a/sub/x', '/a/sub/y', '/b/sub/x', '/b/sub/y'])
+        c = self.root.commit()
+        self.assertEqual(sorted(x.path for x in c.items()), ['/a', '/a/sub', '/a/sub/y', '/b', '/b/sub', '/b/sub/x'])
+        self.assertEqual(self.root.trees()[0], c.tree_key)
+
+    def test_change_journal_without_commit(self):
+        for i in range(10):
+            self.root.put('/a/b', 'version {}'.format(i).encode('UTF-8'))
+        self.root.rename('/a', '/c')
+        self.root.remove('/c/b')
+        self.root.put('/d', b'd')
+        self.assertFalse(models.Change.objects.exists())
+        self.assertTrue(self.root.dirty)
+        c = self.root.commit()
+        self.assertEqual(sorted(x.path for x in c.items()), ['/c', '/d'])
+        self.root.put('/e', b'e')
+        self.assertEqual(list(self.root.changes()), ['/e'])
+
+    def test_change_journal(self):
+        for name in ('/a/b/c', '/a/b/d', '/e/f', '/g'):
+            self.root.put(name, name.encode('UTF-8'))
+        self.root.commit()
+        self.assertFalse(models.Change.objects.exists())
+        with self.assertNumQueries(1):
+            self.assertFalse(self.root.dirty)
+        self.root.put('/e/h', b'new')
+        self.root.rename('/a', '/x/y')
+        self.root.remove('/g')
+        with self.assertNumQueries(1):
+            self.assertTrue(self.root.dirty)
+        # the directories of a moved subtree are recorded too
+        self.assertEqual(set(self.root.changes()), {'/e/h', '/a', '/x', '/x/y', '/x/y/b', '/g'})
+        # the same trees as hashing every file
+        full_key, _ = self.root.trees()
+        self.assertEqual(self.root.trees(self.root.base_commit)[0], full_key)
+        c = self.root.commit()
+        self.assertEqual(c.tree_key, full_key)
+        self.assertEqual(c.get('/x/y/b/c').data, b'/a/b/c')
+        self.assertFalse(self.root.dirty)
+        # a stale instance does not reset the counter
+        stale = models.Root.objects.get(pk=self.root.pk)
+        self.root.put('/e/h', b'changed')
+        stale.save()
+        self.assertTrue(self.root.dirty)
+
+    def test_checkout(self):
+        for name in ('/a/b/c', '/a/b/d', '/e/f', '/g', '/h'):
+            self.root.put(name, name.encode('UTF-8'))
+        for i in range(50):
+            self.root.put('/big/{}'.format(i), self.sample_data)
+        c1 = self.root.commit()
+        self.root.put('/e/f', b'changed')
+        self.root.remove('/a')
+        self.root.remove('/g')
+        self.root.mkdir('/g')
+        self.root.put('/g/i/j', b'new')
+        self.root.rename('/h', '/k')
+        c2 = self.root.commit()
+        self.root.put('/uncommitted', b'lost')
+
+        self.root.checkout(c1)
+        self.assertEqual(self.root.base_commit, c1)
+        self.assertFalse(self.root.dirty)
+        self.assertEqual(self.root.trees()[0], c1.tree_key)
+        self.assertEqual(self.root.get('/e/f').data, b'/e/f')
+        self.assertEqual(self.root.get('/a/b/c').data, b'/a/b/c')
+        self.assertEqual(self.root.get('/a/b/c').parent, self.root.get('/a/b'))
+        self.assertFalse(self.root.exists('/uncommitted'))
+        self.assertFalse(self.root.exists('/g/i'))
+        self.assertEqual(sorted(x.filename for x in self.root.listdir('/')), ['a', 'big', 'e', 'g', 'h'])
+
+        self.root.put('/e/f', b'again')
+        self.assertTrue(self.root.dirty)
+        with CaptureQueriesContext(connection) as queries:
+            self.root.checkout(c2)
+        # the unchanged directories are not read
+        self.assertLess(len(queries), 40)
+        self.assertFalse(self.root.dirty)
+        self.assertEqual(self.root.trees()[0], c2.tree_key)
+        self.assertEqual(self.root.get('/g/i/j').data, b'new')
+        c3 = self.root.commit()
+        self.assertEqual(c3.tree_key, c2.tree_key)
+
+    def test_diff(self):
+        for name in ('/a/b/c', '/e/f', '/g', '/h'):
+            self.root.put(name, name.encode('UTF-8'))
+        c1 = self.root.commit()
+        self.root.put('/e/f', b'changed')
+        self.root.remove('/a')
+        self.root.put('/x/y', b'new')
+        c2 = self.root.commit()
+        expected = [
+            ('removed', '/a'), ('added', '/x'),
+            ('removed', '/a/b'), ('modified', '/e/f'), ('added', '/x/y'),
+            ('removed', '/a/b/c')]
+        self.assertEqual([(x.status, x.path) for x in c1.diff(c2)], expected)
+        self.assertEqual([(x.status, x.path) for x in c1.diff()], expected)
+        self.assertEqual(list(self.root.diff()), [])
+        self.root.put('/h', b'changed')
+        records = list(self.root.diff())
+        self.assertEqual([(x.status, x.path) for x in records], [('modified', '/h')])
+        self.assertEqual(records[0].old.data, b'/h')
+        self.assertEqual(records[0].new.data, b'changed')
+
+        expected = ['D /a/', 'A /x/', 'D /a/b/', 'M /e/f', 'A /x/y', 'D /a/b/c']
+        models.Commit.objects.filter(pk=c1.pk).update(key='a' * 40)
+        models.Commit.objects.filter(pk=c2.pk).update(key='b' * 40)
+        out = six.StringIO()
+        call_command('django_sftpserver_diff', 'test', '--from', str(c1.pk), '--to', 'bbbbbbbb', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), expected)
+        # an all digit key prefix is not taken for an id
+        models.Commit.objects.filter(pk=c2.pk).update(key='12345678' + '0' * 32)
+        out = six.StringIO()
+        call_command('django_sftpserver_diff', 'test', '--from', 'aaaaaaaa', '--to', '12345678', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), expected)
+        out = six.StringIO()
+        call_command('django_sftpserver_diff', 'test', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), ['M /h'])
+
+    def test_diff_concurrent_commit(self):
+        self.root.put('/a', b'a')
+        self.root.commit()
+        self.root.put('/b', b'b')
+        other = models.Root.objects.get(pk=self.root.pk)
+        trees = self.root.trees
+        calls = []
+
+        def commit_first(base_commit):
+            # another session commits while the current files are read
+            if not calls:
+                other.commit()
+            calls.append(base_commit)
+            return trees(base_commit)
+        self.root.trees = commit_first
+        self.assertEqual(list(self.root.diff()), [])
+        self.assertEqual(len(calls), 2)
+
+    def test_checkout_rename_into_place(self):
+        self.root.put('/in/sub/old', b'old')
+        self.root.put('/staging/sub/new', b'new')
+        c1 = self.root.commit()
+        self.root.remove('/in')
+        self.root.rename('/staging', '/in')
+        c2 = self.root.commit()
+        self.root.checkout(c1)
+        self.assertEqual(self.root.get('/in/sub/old').data, b'old')
+        self.assertFalse(self.root.exists('/in/sub/new'))
+        self.root.checkout(c2)
+        self.assertEqual(self.root.get('/in/sub/new').data, b'new')
+        self.assertFalse(self.root.exists('/in/sub/old'))
+        self.assertFalse(self.root.exists('/staging'))
+        self.assertFalse(self.root.dirty)
+        self.assertEqual(self.root.trees()[0], c2.tree_key)
+
+    def test_checkout_other_root(self):
+        other = models.Root.objects.create(name='other')
+        other.put('/a', b'a')
+        c = other.commit()
+        self.root.put('/b', b'b')
+        self.assertRaises(ValueError, self.root.checkout, c)
+        self.assertIsNone(models.Root.objects.get(pk=self.root.pk).base_commit)
+        self.assertEqual(self.root.get('/b').data, b'b')
+
+    def test_commit_items(self):
+        self.root.put('/a/b', self.sample_data)
+        c = models.Commit.objects.create(root=self.root)
+        for item in models.MetaFile.objects.filter(root=self.root):
+            models.CommitItem.objects.create(commit=c, path=item.path, key=item.key,
+                                             size=item.size, mtime=item.mtime, mode=item.mode)
+        self.root.base_commit = c
+        self.root.save()
+        self.assertFalse(self.root.dirty)
+        self.assertEqual(models.Commit.objects.get(pk=c.pk).tree_key, self.root.trees()[0])
+        self.assertEqual(c.get('/a/b').data, self.sample_data)
+
+
+class TestDjango_sftpserver_permission(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        self.group = Group.objects.create(name='group')
+        self.root0 = models.Root.objects.create(name='root0')
+        self.root1 = models.Root.objects.create(name='root1')
+        self.root2 = models.Root.objects.create(name='root2')
+        self.root0.users.add(self.user)
+        self.root1.groups.add(self.group)
+
+    def test_groups(self):
+        self.assertEqual(set(models.Root.accessible_by(self.user)), {self.root0})
+        self.user.groups.add(self.group)
+        self.assertEqual(set(models.Root.accessible_by(self.user)), {self.root0, self.root1})
+        self.assertTrue(self.root1.has_permission(self.user))
+        self.assertFalse(self.root2.has_permission(self.user))
+        self.root2.groups.add(self.group)
+        self.assertTrue(self.root2.has_permission(self.user))
+        self.group.delete()
+        self.assertEqual(set(models.Root.accessible_by(self.user)), {self.root0})
+
+    def test_cached(self):
+        self.assertTrue(self.root0.has_permission(self.user))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.root0.has_permission(self.user))
+            self.assertFalse(self.root1.has_permission(self.user))
+        self.root0.users.remove(self.user)
+        self.assertFalse(self.root0.has_permission(self.user))
+
+    @override_settings(SFTPSERVER_PERMISSION_CACHE_TIMEOUT=0)
+    def test_not_cached(self):
+        self.assertTrue(self.root0.has_permission(self.user))
+        # without a signal, as a change made by another process
+        models.Root.users.through.objects.filter(root=self.root0).delete()
+        self.assertFalse(self.root0.has_permission(self.user))
+
+    def test_version_evicted(self):
+        self.assertTrue(self.root0.has_permission(self.user))
+        version = models._permission_version()
+        self.root0.users.remove(self.user)
+        self.assertNotEqual(models._permission_version(), version)
+        # losing the version must not bring back a set cached under an old one
+        cache.delete(models.PERMISSION_VERSION_KEY)
+        self.assertNotEqual(models._permission_version(), version)
+        self.assertFalse(self.root0.has_permission(self.user))
+
+    def test_storage_access_info(self):
+        sai = models.StorageAccessInfo.objects.create(name='storage')
+        self.assertFalse(sai.has_permission(self.user))
+        sai.groups.add(self.group)
+        self.user.groups.add(self.group)
+        self.assertTrue(sai.has_permission(self.user))
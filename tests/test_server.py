@@ -0,0 +1,199 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+import paramiko
+from django.test import SimpleTestCase
+
+from django_sftpserver.server import HandshakePool, SessionRegistry, load_host_key
+
+if sys.version_info[0] == 2:
+    import backports.unittest_mock
+    backports.unittest_mock.install()
+
+from unittest.mock import Mock  # NOQA
+
+try:
+    import asyncssh
+    from django_sftpserver import asyncio_sftpserver
+except (ImportError, SyntaxError):
+    asyncssh = None
+
+
+class TestDjango_sftpserver_handshake_pool(SimpleTestCase):
+
+    def test_slow_handshake_does_not_block(self):
+        blocker = threading.Event()
+        done = []
+
+        def transport_factory(conn, addr):
+            transport = Mock()
+            if addr == 'slow':
+                transport.start_server = Mock(side_effect=lambda server: blocker.wait(5))
+            transport.accept = Mock(side_effect=lambda timeout: done.append(addr) or Mock())
+            return transport, Mock()
+
+        pool = HandshakePool(transport_factory, max_handshakes=2)
+        try:
+            pool.submit(Mock(), 'slow')
+            pool.submit(Mock(), 'fast')
+            for _ in range(50):
+                if done:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(done, ['fast'])
+        finally:
+            blocker.set()
+            pool.shutdown()
+
+    def test_max_sessions(self):
+        pool = HandshakePool(Mock(), max_handshakes=1, max_sessions=1)
+        try:
+            transport = Mock()
+            transport.is_active = Mock(return_value=True)
+            pool.sessions.add(transport, Mock(), Mock())
+            conn = Mock()
+            self.assertFalse(pool.submit(conn, 'addr'))
+            conn.close.assert_called_once_with()
+
+            transport.is_active = Mock(return_value=False)
+            pool.transport_factory = Mock(side_effect=Exception('stop here'))
+            self.assertTrue(pool.submit(Mock(), 'addr'))
+        finally:
+            pool.shutdown()
+
+    def _blocked_pool(self, done):
+        blocker = threading.Event()
+
+        def transport_factory(conn, addr):
+            transport = Mock()
+            if addr == 'busy':
+                transport.start_server = Mock(side_effect=lambda server: blocker.wait(5))
+            transport.accept = Mock(side_effect=lambda timeout: done.append(addr) or Mock())
+            return transport, Mock()
+
+        pool = HandshakePool(transport_factory, max_handshakes=1)
+        pool.submit(Mock(), 'busy')
+        return pool, blocker
+
+    def test_shutdown_completes_queued(self):
+        done = []
+        pool, blocker = self._blocked_pool(done)
+        conn = Mock()
+        pool.submit(conn, 'queued')
+        threading.Timer(0.2, blocker.set).start()
+        pool.shutdown(wait=True, timeout=5)
+        self.assertEqual(done, ['busy', 'queued'])
+        self.assertFalse(conn.close.called)
+
+    def test_shutdown_drop_pending(self):
+        done = []
+        pool, blocker = self._blocked_pool(done)
+        conn = Mock()
+        # the busy handshake is running once the queue is empty again
+        for _ in range(50):
+            if pool._queue.empty():
+                break
+            time.sleep(0.1)
+        pool.submit(conn, 'queued')
+        threading.Timer(0.2, blocker.set).start()
+        pool.shutdown(wait=True, timeout=5, drop_pending=True)
+        self.assertEqual(done, ['busy'])
+        conn.close.assert_called_once_with()
+
+
+class TestDjango_sftpserver_session_registry(SimpleTestCase):
+
+    def _transport(self, active=True):
+        transport = Mock()
+        transport.is_active = Mock(return_value=active)
+        transport.close = Mock(side_effect=lambda: setattr(transport, 'is_active', Mock(return_value=False)))
+        return transport
+
+    def test_reap_finished(self):
+        registry = SessionRegistry()
+        registry.add(self._transport(), Mock(), Mock())
+        registry.add(self._transport(active=False), Mock(), Mock())
+        self.assertEqual(len(registry), 1)
+
+    def test_idle_timeout(self):
+        registry = SessionRegistry(idle_timeout=60)
+        idle, busy = self._transport(), self._transport()
+        registry.add(idle, Mock(), Mock(last_activity=time.time() - 120))
+        registry.add(busy, Mock(), Mock(last_activity=time.time()))
+        self.assertEqual(len(registry), 1)
+        idle.close.assert_called_once_with()
+        self.assertFalse(busy.close.called)
+
+    def test_max_lifetime(self):
+        registry = SessionRegistry(max_lifetime=60)
+        transport = self._transport()
+        session = registry.add(transport, Mock(), Mock(last_activity=time.time()))
+        session.started_at -= 120
+        self.assertEqual(len(registry), 0)
+        transport.close.assert_called_once_with()
+
+    def test_drain(self):
+        registry = SessionRegistry()
+        transport = self._transport()
+        registry.add(transport, Mock(), Mock())
+        self.assertEqual(registry.drain(0.2, poll_interval=0.1), 1)
+        transport.close.assert_called_once_with()
+        self.assertEqual(len(registry), 0)
+
+
+class TestDjango_sftpserver_host_keys(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_host_key(self):
+        for key in (paramiko.RSAKey.generate(1024), paramiko.ECDSAKey.generate()):
+            filename = os.path.join(self.directory, key.get_name())
+            key.write_private_key_file(filename)
+            loaded = load_host_key(filename)
+            self.assertEqual(loaded.get_name(), key.get_name())
+            self.assertEqual(loaded.get_base64(), key.get_base64())
+
+    def test_load_invalid_host_key(self):
+        filename = os.path.join(self.directory, 'invalid')
+        with open(filename, 'w') as f:
+            f.write('invalid')
+        with self.assertRaises(paramiko.SSHException):
+            load_host_key(filename)
+
+
+@unittest.skipIf(asyncssh is None, 'asyncssh is not installed')
+class TestDjango_sftpserver_asyncio_engine(SimpleTestCase):
+
+    def test_convert_pflags(self):
+        self.assertEqual(asyncio_sftpserver._convert_pflags(asyncssh.FXF_READ), os.O_RDONLY)
+        self.assertEqual(asyncio_sftpserver._convert_pflags(asyncssh.FXF_WRITE | asyncssh.FXF_CREAT),
+                         os.O_WRONLY | os.O_CREAT)
+        self.assertEqual(asyncio_sftpserver._convert_pflags(
+            asyncssh.FXF_READ | asyncssh.FXF_WRITE | asyncssh.FXF_APPEND), os.O_RDWR | os.O_APPEND)
+
+    def test_public_key(self):
+        pkey = paramiko.RSAKey.generate(1024)
+        key = asyncio_sftpserver.import_host_key(pkey)
+        public_key = asyncio_sftpserver._PublicKey(key)
+        self.assertEqual(public_key.get_name(), pkey.get_name())
+        self.assertEqual(public_key.get_base64(), pkey.get_base64())
+
+    def test_check(self):
+        self.assertEqual(asyncio_sftpserver._check(b'data'), b'data')
+        with self.assertRaises(asyncssh.SFTPError) as cm:
+            asyncio_sftpserver._check(paramiko.SFTP_NO_SUCH_FILE)
+        self.assertEqual(cm.exception.code, asyncssh.FX_NO_SUCH_FILE)
@@ -7,6 +7,7 @@ import sys
 import os
 import uuid
 import shutil
+import stat as _stat
 import paramiko
 
 from django.contrib.auth import get_user_model
@@ -100,6 +101,26 @@ class TestDjango_sftpserver_sftpserver_without_root(TestCase):
         print(self.sftpserver.list_folder('/root1'))
         # print(self.sftpserver.list_folder('/root2'))
 
+    def test_resolve_cache(self):
+        self.assertEqual(self.sftpserver._resolve('/root0/a'), (self.root0, '/a'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.sftpserver._resolve('/root0/b'), (self.root0, '/b'))
+        self.root0.users.remove(self.user)
+        self.assertRaises(Exception, self.sftpserver._resolve, '/root0/a')
+        self.root0.users.add(self.user)
+        self.assertEqual(self.sftpserver._resolve('/root0/a'), (self.root0, '/a'))
+
+    def test_list_folder_attrs(self):
+        self.root0.put('/d/a', b'abc')
+        self.root0.mkdir('/d/e')
+        result = {x.filename: x for x in self.sftpserver.list_folder('/root0/d')}
+        self.assertEqual(sorted(result), ['a', 'e'])
+        self.assertEqual(result['a'].st_size, 3)
+        self.assertTrue(_stat.S_ISREG(result['a'].st_mode))
+        self.assertTrue(_stat.S_ISDIR(result['e'].st_mode))
+        self.assertEqual(self.sftpserver.list_folder('/root0/d/e'), [])
+        self.assertEqual(self.sftpserver.list_folder('/root0/missing'), paramiko.SFTP_NO_SUCH_FILE)
+
     def test_stat(self):
         self.sftpserver.stat('/')
         self.root0.put("/a/b", b"c")
@@ -114,6 +135,22 @@ class TestDjango_sftpserver_sftpserver_without_root(TestCase):
         print(self.sftpserver.open('/root0/a/b', os.O_RDONLY, None).readfile.getvalue())
         self.sftpserver.open('/root0/a/c', os.O_WRONLY, None).write(0, b'c')
 
+    def test_write(self):
+        handle = self.sftpserver.open('/root0/w', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, None)
+        for i in range(0, 10):
+            handle.write(i * 4, b'abcd')
+        handle.close()
+        self.assertEqual(self.root0.get('/w').data, b'abcd' * 10)
+
+        handle = self.sftpserver.open('/root0/w', os.O_WRONLY | os.O_APPEND, None)
+        handle.write(0, b'efgh')
+        handle.close()
+        self.assertEqual(self.root0.get('/w').data, b'abcd' * 10 + b'efgh')
+
+        handle = self.sftpserver.open('/root0/w', os.O_WRONLY | os.O_TRUNC, None)
+        handle.close()
+        self.assertEqual(self.root0.get('/w').data, b'')
+
     def test_remove(self):
         pass
 
@@ -17,13 +17,28 @@ import moto.server as moto_server
 import boto
 import yaml
 import random
+import signal
+import unittest
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
 # from django.test import SimpleTestCase as TestCase
 
 from django_sftpserver.management.commands.django_sftpserver_run import Command
-from django_sftpserver import models
+from django_sftpserver import models, sftpserver
+
+if sys.version_info[0] == 2:
+    import backports.unittest_mock
+    backports.unittest_mock.install()
+
+from unittest import mock  # NOQA
+from unittest.mock import Mock  # NOQA
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
 
 
 class ServerMixin(object):
@@ -193,6 +208,181 @@ class TestDjango_sftpserver_sftpserver_command_s3storage(ServerMixin, TestCase):
             print(client.listdir('./{}'.format(self.storage_name_0)), client.listdir_attr())
 
 
+class TestDjango_sftpserver_run_options(SimpleTestCase):
+
+    def handle(self, **options):
+        defaults = dict(level='ERROR', socket_filename=None, storage_mode=False)
+        defaults.update(options)
+        Command().handle(**defaults)
+
+    def test_reuse_port_options(self):
+        with self.assertRaisesRegex(CommandError, '--socket-filename'):
+            self.handle(reuse_port=True, workers=2, socket_filename='/tmp/x.sock')
+        with self.assertRaisesRegex(CommandError, '--workers'):
+            self.handle(reuse_port=True)
+
+    def test_host_key_required(self):
+        with self.assertRaisesRegex(CommandError, 'host key'):
+            self.handle()
+
+    def test_reuse_port_bind(self):
+        command = Command()
+        options = dict(socket_filename=None, host='127.0.0.1', port=0)
+        first = command.bind(options, reuse_port=True)
+        try:
+            options['port'] = first.getsockname()[1]
+            second = command.bind(options, reuse_port=True)
+            second.close()
+        finally:
+            first.close()
+
+
+class TestDjango_sftpserver_prefork(SimpleTestCase):
+
+    def setUp(self):
+        self.signals = {x: signal.getsignal(x) for x in (signal.SIGTERM, signal.SIGINT)}
+        self.command = Command()
+        self.command.cont = True
+        self.command.POLL_INTERVAL = 0.05
+        self.command.RESPAWN_DELAY = 0.4
+
+    def tearDown(self):
+        for signum, handler in self.signals.items():
+            signal.signal(signum, handler)
+
+    def prefork(self, serve, duration):
+        forks = []
+        fork = os.fork
+
+        def counting_fork():
+            forks.append(1)
+            return fork()
+        self.command.serve = serve
+        threading.Timer(duration, self.command.stop).start()
+        with mock.patch('os.fork', counting_fork):
+            self.command.prefork(Mock(), 1, {})
+        return len(forks)
+
+    def test_respawn_backoff(self):
+        # fails at startup: spawned at 0, 0.4 and 1.2 seconds
+        self.assertIn(self.prefork(Mock(side_effect=Exception('bind error')), 1.5), (2, 3, 4))
+
+    def test_respawn_recycled(self):
+        self.assertGreaterEqual(self.prefork(lambda *args, **kwargs: time.sleep(0.1), 1), 4)
+
+    def test_respawn_draining(self):
+        def serve(*args, **kwargs):
+            # recycled at once, then busy with its sessions until SIGTERM
+            self.command.recycling()
+            while self.command.cont:
+                time.sleep(0.05)
+        # replaced without waiting for the exit, stopped at the end
+        self.assertGreaterEqual(self.prefork(serve, 1), 4)
+
+
+class ServeMixin(object):
+    '''runs Command.serve in a thread, the server and the test share the database'''
+
+    def setUp(self):
+        super(ServeMixin, self).setUp()
+        self.pkey = paramiko.RSAKey.generate(2048)
+        self.user = get_user_model().objects.create(username='username')
+        models.AuthorizedKey.objects.create(
+            user=self.user, key_type=self.pkey.get_name(), key=self.pkey.get_base64())
+        models.Root.objects.create(name='root0').users.add(self.user)
+        self.socket_filename = '/tmp/{}.sock'.format(uuid.uuid4().hex)
+        self.command = Command()
+        self.command.cont = True
+        self.command.POLL_INTERVAL = 0.1
+        self.command.host_keys = self.command.load_host_keys({'pkey': self.pkey})
+        self.command.sftpserver_module = sftpserver
+
+    def tearDown(self):
+        self.command.cont = False
+        if os.path.exists(self.socket_filename):
+            os.unlink(self.socket_filename)
+        super(ServeMixin, self).tearDown()
+
+    def serve(self, **options):
+        options.setdefault('drain_timeout', 10)
+        options.update(socket_filename=self.socket_filename)
+        thread = threading.Thread(target=self.command.serve, args=(self.command.bind(options), options),
+                                  kwargs={'worker': True})
+        thread.start()
+        self.addCleanup(thread.join)
+        return thread
+
+    def connect(self):
+        client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client_socket.connect(self.socket_filename)
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.WarningPolicy)
+        ssh.connect('localhost', username='username', pkey=self.pkey, sock=client_socket)
+        return ssh, ssh.open_sftp()
+
+    @contextmanager
+    def create_client(self):
+        ssh, sftp = self.connect()
+        try:
+            yield sftp
+        finally:
+            sftp.close()
+            ssh.close()
+
+    def check_session(self):
+        with self.create_client() as sftp:
+            with sftp.open('/root0/a', 'w') as f:
+                f.write(b'data')
+            with sftp.open('/root0/a') as f:
+                self.assertEqual(f.read(), b'data')
+            self.assertEqual(sftp.listdir('/root0'), ['a'])
+            self.assertEqual(sftp.stat('/root0/a').st_size, 4)
+
+    def check_recycled(self, **options):
+        self.command.recycling = Mock()
+        thread = self.serve(worker_sessions=1, drain_timeout=0, **options)
+        ssh, sftp = self.connect()
+        self.addCleanup(ssh.close)
+        # recycled, but the session outlives the drain timeout
+        time.sleep(1)
+        self.command.recycling.assert_called_once_with()
+        with sftp.open('/root0/a', 'w') as f:
+            f.write(b'data')
+        self.assertTrue(thread.is_alive())
+        # a shutdown closes it after the drain timeout
+        self.command.stop()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertRaises((EOFError, socket.error, paramiko.SSHException), sftp.listdir, '/root0')
+
+
+class TestDjango_sftpserver_worker_recycling(ServeMixin, TransactionTestCase):
+
+    def test_last_session_is_served(self):
+        thread = self.serve(worker_sessions=1)
+        self.check_session()
+        # the worker stops once its only session ended
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+    def test_recycled_sessions_are_kept(self):
+        self.check_recycled()
+
+
+@unittest.skipIf(asyncssh is None, 'asyncssh is not installed')
+class TestDjango_sftpserver_asyncio_engine(ServeMixin, TransactionTestCase):
+
+    def test_session(self):
+        self.command.host_keyfiles = [self.pkey]
+        self.serve(engine='asyncio')
+        self.check_session()
+        self.check_session()
+
+    def test_recycled_sessions_are_kept(self):
+        self.command.host_keyfiles = [self.pkey]
+        self.check_recycled(engine='asyncio')
+
+
 if sys.version_info[0] == 2:
     for i in (x for x in dir() if x.startswith("TestDjango_sftpserver")):
         globals().pop(i)